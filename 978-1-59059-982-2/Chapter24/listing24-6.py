@@ -1,9 +1,26 @@
-from asyncore import dispatcher
-from asynchat import async_chat
-import socket, asyncore
+from multiprocessing import Process
+from collections import deque
+from tempfile import mkdtemp
+from shutil import rmtree
+from os.path import join
+import asyncio, socket, json, sys
 
 PORT = 5005
 NAME = 'TestChat'
+BACKLOG = 1024 # Connections waiting to be accepted
+MAX_LINE = 8192 # Bytes in a line at most
+# Bytes in a message to or from a Hub at most: a room name, user name
+# and line said (the room name twice) of up to MAX_LINE bytes each,
+# where JSON may take six bytes (as in "\ufffd") for each byte received:
+HUB_LIMIT = 6 * 4 * MAX_LINE + 1024
+
+HIGH_WATER = 64 * 1024 # Bytes buffered for a connection before it's
+                       # considered slow, and messages are queued
+MAX_QUEUE = 256        # Messages queued for a slow session at most
+POLICY = 'coalesce'    # What to do when the queue is full: 'drop' the
+                       # new message, 'disconnect' the session, or
+                       # 'coalesce' the queue into a note of what was
+                       # skipped
 
 class EndSession(Exception): pass
 
@@ -44,11 +61,11 @@ class Room(CommandHandler):
 
     def __init__(self, server):
         self.server = server
-        self.sessions = []
+        self.sessions = set()
 
     def add(self, session):
         'A session (user) has entered the room'
-        self.sessions.append(session)
+        self.sessions.add(session)
 
     def remove(self, session):
         'A session (user) has left the room'
@@ -56,8 +73,14 @@ class Room(CommandHandler):
 
     def broadcast(self, line):
         'Send a line to all sessions in the room'
+        self.deliver(line)
+
+    def deliver(self, line):
+        'Send a line to the sessions in the room in this process'
+        # Encode the line once, and share it among the sessions:
+        data = line.encode('utf-8')
         for session in self.sessions:
-            session.push(line)
+            session.send(data)
 
 
     def do_logout(self, session, line):
@@ -84,49 +107,100 @@ class LoginRoom(Room):
         # Make sure the user has entered a name:
         if not name:
             session.push('Please enter a name\r\n')
-        # Make sure that the name isn't in use:
-        elif name in self.server.users:
-            session.push('The name "%s" is taken.\r\n' % name)
-            session.push('Please try again.\r\n')
         else:
-            # The name is OK, so it is stored in the session, and
-            # the user is moved into the main room.
-            session.name = name
-            session.enter(self.server.main_room)
+            # The server makes sure that the name isn't in use:
+            self.server.claim(session, name)
 
 class ChatRoom(Room):
     """
-    A room meant for multiple users who can chat with the others in
-    the room.
+    A named room meant for multiple users who can chat with the others
+    in the room. A user may be in several rooms at once; the one the
+    user last joined is the one where the user's commands are handled.
     """
 
+    def __init__(self, server, name):
+        Room.__init__(self, server)
+        self.name = name
+
     def add(self, session):
         # Notify everyone that a new user has entered:
         self.broadcast(session.name + ' has entered the room.\r\n')
-        self.server.users[session.name] = session
         Room.add(self, session)
+        session.rooms.add(self)
+        self.server.entered(self, session)
 
 
     def remove(self, session):
         Room.remove(self, session)
+        session.rooms.discard(self)
         # Notify everyone that a user has left:
         self.broadcast(session.name + ' has left the room.\r\n')
+        self.server.exited(self, session)
+        if not self.sessions: self.server.close(self)
+
+    def broadcast(self, line):
+        # Lines from rooms other than the main one are marked with the
+        # room name. The server passes them on to other processes, if any:
+        if self is not self.server.main_room:
+            line = '[%s] %s' % (self.name, line)
+        self.deliver(line)
+        self.server.publish(self, line)
 
     def do_say(self, session, line):
         self.broadcast(session.name+': '+line+'\r\n')
 
+    def do_join(self, session, line):
+        'Handles the join command, used to enter (or switch to) a room'
+        name = line.strip()
+        if not name:
+            session.push('Please enter a room name\r\n')
+            return
+        room = self.server.room(name)
+        if session not in room.sessions: room.add(session)
+        session.room = room
+
+    def do_part(self, session, line):
+        'Handles the part command, used to leave a room (this by default)'
+        room = self.server.rooms.get(line.strip() or self.name)
+        if room not in session.rooms:
+            session.push('You are not in that room\r\n')
+        elif len(session.rooms) == 1:
+            session.push('You cannot leave your last room\r\n')
+        else:
+            room.remove(session)
+            if session.room is room:
+                # Go back to the main room, if the user is in it:
+                rooms = session.rooms & {self.server.main_room}
+                session.room = (rooms or session.rooms).pop()
+
+    def do_rooms(self, session, line):
+        'Handles the rooms command, used to see which rooms there are'
+        session.push('The following rooms are open:\r\n')
+        for name, count in self.server.room_list():
+            session.push('%s (%d)\r\n' % (name, count))
+
     def do_look(self, session, line):
         'Handles the look command, used to see who is in a room'
         session.push('The following are in this room:\r\n')
-        for other in self.sessions:
-            session.push(other.name + '\r\n')
+        for name in self.server.members(self):
+            session.push(name + '\r\n')
 
     def do_who(self, session, line):
         'Handles the who command, used to see who is logged in'
         session.push('The following are logged in:\r\n')
-        for name in self.server.users:
+        for name in self.server.names():
             session.push(name + '\r\n')
 
+    def do_stats(self, session, line):
+        'Handles the stats command, used to see how the server is doing'
+        for name, value in sorted(self.server.stats().items()):
+            if not isinstance(value, dict):
+                session.push('%s: %s\r\n' % (name, value))
+                continue
+            session.push('%s:\r\n' % name)
+            for key, item in sorted(value.items()):
+                session.push('  %s: %s\r\n' % (key, item))
+
 class LogoutRoom(Room):
     """
     A simple room for a single user. Its sole purpose is to remove
@@ -135,23 +209,85 @@ class LogoutRoom(Room):
 
     def add(self, session):
         # When a session (user) enters the LogoutRoom it is deleted
-        try: del self.server.users[session.name]
-        except KeyError: pass
+        self.server.logout(session)
 
-class ChatSession(async_chat):
+class LineFramer:
+    """
+    Splits the data received on a connection into lines ending with
+    "\r\n". The data is kept in a bytearray, which grows in place, and
+    is only searched from where the last search left off, so a long line
+    arriving in many small pieces costs no more than a short one; the
+    complete lines are then split off all at once.
+    Lines longer than max_line are skipped, so a user cannot make the
+    server keep any amount of data.
+    """
+
+    def __init__(self, max_line=MAX_LINE):
+        self.max_line = max_line
+        self.buffer = bytearray()
+        self.searched = 0
+        self.skipping = False
+
+    def feed(self, data):
+        """
+        Adds data, and returns a list of the complete lines in it
+        (without the "\r\n"), with None in place of any line too long.
+        """
+        buffer = self.buffer
+        buffer += data
+        end = buffer.rfind(b'\r\n', self.searched)
+        if end < 0:
+            lines = []
+        else:
+            # Split all the complete lines at once:
+            with memoryview(buffer) as view:
+                lines = bytes(view[:end]).split(b'\r\n')
+            del buffer[:end+2]
+            if self.skipping:
+                # The rest of a line that was too long:
+                self.skipping = False
+                del lines[0]
+            # No line can be too long if they all fit in max_line:
+            if end > self.max_line and \
+                   max(map(len, lines), default=0) > self.max_line:
+                lines = [line if len(line) <= self.max_line else None
+                         for line in lines]
+        if len(buffer) > self.max_line + 1:
+            # Throw away the line so far (except a final "\r", which
+            # may begin the "\r\n"), and skip the rest of it:
+            if not self.skipping: lines.append(None)
+            self.skipping = True
+            del buffer[:-1]
+        # The "\r" of the next "\r\n" may already be in the buffer:
+        self.searched = max(len(buffer) - 1, 0)
+        return lines
+
+class ChatSession(asyncio.Protocol):
     """
     A single session, which takes care of the communication with a
-    single user.
+    single user. The event loop calls connection_made, data_received
+    and connection_lost as things happen on the connection, and
+    pause_writing and resume_writing as the data waiting to be sent
+    goes above HIGH_WATER and back down. While writing is paused, the
+    messages for the user wait in a queue of their own.
     """
 
-    def __init__(self, server, sock):
-        async_chat.__init__(self, sock)
+    def __init__(self, server):
         self.server = server
-        self.set_terminator("\r\n")
-        self.data = []
+        self.transport = None
+        self.framer = LineFramer()
         self.name = None
+        self.rooms = set()
+        self.queue = deque()
+        self.skipped = 0
+        self.paused = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+        transport.set_write_buffer_limits(high=HIGH_WATER)
+        self.server.sessions.add(self)
         # All sessions begin in a separate LoginRoom:
-        self.enter(LoginRoom(server))
+        self.enter(LoginRoom(self.server))
 
 
     def enter(self, room):
@@ -163,40 +299,418 @@ class ChatSession(async_chat):
         self.room = room
         room.add(self)
 
-    def collect_incoming_data(self, data):
-        self.data.append(data)
-
-    def found_terminator(self):
-        line = ''.join(self.data)
-        self.data = []
+    def push(self, line):
+        'Send a line to the user'
+        self.send(line.encode('utf-8'))
+
+    def send(self, data):
+        """
+        Send encoded data to the user, or queue it if the connection
+        can't keep up. If the queue is full, the server's policy decides.
+        """
+        if self.transport.is_closing(): return
+        if not self.paused:
+            self.transport.write(data)
+        elif len(self.queue) < MAX_QUEUE:
+            self.queue.append(data)
+        else:
+            self.overflow(data)
+
+    def overflow(self, data):
+        'Called when there is no room in the queue for more data'
+        policy = self.server.policy
+        if policy == 'disconnect':
+            self.server.count('disconnected')
+            # Closing would wait for the buffered data to be sent:
+            self.queue.clear()
+            self.transport.abort()
+        elif policy == 'coalesce':
+            # The skipped messages are noted (all in one) when writing
+            # resumes, ahead of those still queued:
+            self.server.count('dropped', len(self.queue))
+            self.skipped += len(self.queue)
+            self.queue.clear()
+            self.queue.append(data)
+        else:
+            self.server.count('dropped')
+
+    def depth(self):
+        'Returns the number of messages waiting in the queue'
+        return len(self.queue)
+
+    def label(self):
+        'Returns the name of the user, or the address before logging in'
+        if self.name: return self.name
+        peer = self.transport.get_extra_info('peername') or ('?', 0)
+        return '%s:%s' % peer[:2]
+
+    def pause_writing(self):
+        self.paused = True
+
+    def resume_writing(self):
+        self.paused = False
+        # Writing may be paused again before the queue is empty:
+        if self.skipped:
+            self.push('*** %d messages skipped ***\r\n' % self.skipped)
+            self.skipped = 0
+        while self.queue and not self.paused:
+            self.transport.write(self.queue.popleft())
+
+    def data_received(self, data):
+        # Handle each complete line; the framer keeps the rest for later:
+        for line in self.framer.feed(data):
+            if self.transport.is_closing(): break
+            if line is None:
+                self.server.count('overlong')
+                self.push('Lines may be at most %d bytes\r\n' % MAX_LINE)
+            else:
+                self.found_terminator(line.decode('utf-8', 'replace'))
+
+    def found_terminator(self, line):
         try: self.room.handle(self, line)
         except EndSession:
             self.handle_close()
 
     def handle_close(self):
-        async_chat.handle_close(self)
+        self.transport.close()
+
+    def connection_lost(self, exc):
+        self.server.sessions.discard(self)
+        self.queue.clear()
+        # Leave the other rooms; enter leaves the current one:
+        for room in self.rooms - {self.room}:
+            room.remove(self)
         self.enter(LogoutRoom(self.server))
 
-class ChatServer(dispatcher):
+class ChatServer:
     """
-    A chat server with a single room.
+    A chat server with a main room, and any number of other rooms,
+    which are opened when someone joins them and closed when the last
+    user leaves. All the sessions are handled by a
+    single asyncio event loop, which uses epoll (or the like) where it
+    can, so idle connections cost nothing when it looks for work. The
+    policy says what to do with messages for sessions whose queues are
+    full (see POLICY).
     """
 
-    def __init__(self, port, name):
-        dispatcher.__init__(self)
-        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.set_reuse_addr()
-        self.bind(('', port))
-        self.listen(5)
+    reuse_port = False
+
+    def __init__(self, port, name, policy=POLICY):
+        self.port = port
         self.name = name
+        self.policy = policy
         self.users = {}
-        self.main_room = ChatRoom(self)
+        self.sessions = set()
+        self.counters = {'dropped': 0, 'disconnected': 0, 'overlong': 0}
+        self.rooms = {}
+        self.main_room = self.room('main')
+
+    def room(self, name):
+        'Returns the room with the given name, opening it if need be'
+        try: return self.rooms[name]
+        except KeyError:
+            room = self.rooms[name] = ChatRoom(self, name)
+            return room
+
+    def close(self, room):
+        'Close a room that everyone has left (unless it is the main room)'
+        if room is not self.main_room: del self.rooms[room.name]
+
+    def claim(self, session, name):
+        'Log a session in with the given name, unless it is in use'
+        if name in self.users: self.refuse(session, name)
+        else: self.login(session, name)
+
+    def login(self, session, name):
+        # The name is OK, so it is stored in the session, and
+        # the user is moved into the main room.
+        session.name = name
+        self.users[name] = session
+        session.enter(self.main_room)
+
+    def refuse(self, session, name):
+        session.push('The name "%s" is taken.\r\n' % name)
+        session.push('Please try again.\r\n')
+
+    def logout(self, session):
+        'Forget the name of a session that has ended'
+        if self.users.get(session.name) is session:
+            del self.users[session.name]
+
+    def entered(self, room, session):
+        'Called when a user has entered a room'
+        pass
+
+    def exited(self, room, session):
+        'Called when a user has left a room'
+        pass
+
+    def publish(self, room, line):
+        'Pass a line said in a room on to other processes'
+        pass
+
+    def names(self):
+        'Returns the names of the users that are logged in'
+        return list(self.users)
+
+    def members(self, room):
+        'Returns the names of the users in a room'
+        return sorted(session.name for session in room.sessions)
+
+    def room_list(self):
+        'Returns the names of the rooms, and the number of users in each'
+        return sorted((name, len(room.sessions))
+                      for name, room in self.rooms.items())
+
+    def count(self, name, amount=1):
+        'Adds an amount to a counter'
+        self.counters[name] += amount
+
+    def stats(self):
+        """
+        Returns the counters, along with the number of sessions, how many
+        of them are slow (with writing paused), the messages queued in
+        all, the deepest queue, and the depth of the queue of each slow
+        session (or one with messages still queued), by user name.
+        """
+        depths = [session.depth() for session in self.sessions]
+        stats = dict(self.counters)
+        stats.update(sessions=len(depths), rooms=len(self.rooms),
+                     queued=sum(depths),
+                     maxDepth=max(depths or [0]),
+                     slow=len([s for s in self.sessions if s.paused]),
+                     depths=dict((s.label(), s.depth())
+                                 for s in self.sessions
+                                 if s.paused or s.depth()))
+        return stats
+
+    async def serve(self):
+        'Accept connections and handle the sessions, until cancelled'
+        loop = asyncio.get_running_loop()
+        server = await loop.create_server(lambda: ChatSession(self), '',
+                                          self.port, reuse_address=True,
+                                          reuse_port=self.reuse_port,
+                                          backlog=BACKLOG)
+        async with server:
+            await server.serve_forever()
+
+def send(writer, **message):
+    'Send a message (as a line of JSON) over a connection to or from a Hub'
+    writer.write(json.dumps(message).encode('utf-8') + b'\n')
+
+async def receive(reader, handle):
+    """
+    Call handle with the op and the rest of each message received over a
+    connection to or from a Hub, until it is closed. A message that is
+    too long or malformed is reported and skipped; the connection stays.
+    """
+    while True:
+        try:
+            line = await reader.readline()
+            if not line: return
+            message = json.loads(line)
+            handle(message.pop('op'), **message)
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            print('Bad message from hub connection: %r' % e,
+                  file=sys.stderr)
+
+class Hub:
+    """
+    The message bus between the shards of a chat server, each of which
+    is a ShardServer in a process of its own. The shards connect to the
+    hub over a Unix domain socket, and tell it what names their users
+    want, who logs out, who enters and leaves which rooms, and what is
+    said; the hub keeps the names unique and passes the rest on to the
+    other shards. Lines said in a room are passed on only to the shards
+    with users in it.
+    """
+
+    def __init__(self):
+        self.shards = set()
+        self.names = {}
+        self.rooms = {}
+
+    async def serve(self, sock):
+        'Handle the shards connecting to a listening socket'
+        server = await asyncio.start_unix_server(self.connected, sock=sock,
+                                                 limit=HUB_LIMIT)
+        async with server:
+            await server.serve_forever()
+
+    async def connected(self, reader, writer):
+        'Handle the messages from a shard until it is gone'
+        self.shards.add(writer)
+        for name in self.names:
+            send(writer, op='joined', name=name)
+        for room, members in self.rooms.items():
+            for name in members:
+                send(writer, op='entered', room=room, name=name)
+        def handle(op, **message):
+            getattr(self, 'do_' + op)(writer, **message)
+        try:
+            await receive(reader, handle)
+        except asyncio.CancelledError:
+            pass # The hub is shutting down
+        finally:
+            self.shards.discard(writer)
+            for room, members in list(self.rooms.items()):
+                for name, shard in list(members.items()):
+                    if shard is writer: self.do_exit(writer, room, name)
+            for name, shard in list(self.names.items()):
+                if shard is writer: self.do_release(writer, name)
+            writer.close()
+
+    def tell(self, shards, **message):
+        'Send a message to a number of shards'
+        for shard in shards:
+            send(shard, **message)
+
+    def do_claim(self, shard, name):
+        ok = name not in self.names
+        if ok:
+            self.names[name] = shard
+            self.tell(self.shards, op='joined', name=name)
+        send(shard, op='claimed', name=name, ok=ok)
+
+    def do_release(self, shard, name):
+        if self.names.get(name) is shard:
+            del self.names[name]
+            self.tell(self.shards, op='left', name=name)
+
+    def do_enter(self, shard, room, name):
+        self.rooms.setdefault(room, {})[name] = shard
+        self.tell(self.shards, op='entered', room=room, name=name)
+
+    def do_exit(self, shard, room, name):
+        members = self.rooms.get(room, {})
+        if members.get(name) is shard:
+            del members[name]
+            if not members: del self.rooms[room]
+            self.tell(self.shards, op='exited', room=room, name=name)
+
+    def do_say(self, shard, room, line):
+        shards = set(self.rooms.get(room, {}).values())
+        self.tell(shards - {shard}, op='say', room=room, line=line)
+
+class ShardServer(ChatServer):
+    """
+    One of several chat servers in processes of their own, sharing a
+    port (with SO_REUSEPORT, so the kernel spreads the connections among
+    them) and a Hub. Each keeps a copy of the names logged in anywhere,
+    and of who is in which room, which the hub keeps up to date.
+    """
+
+    reuse_port = True
+
+    def __init__(self, port, name, hub, policy=POLICY):
+        ChatServer.__init__(self, port, name, policy)
+        self.hub = hub
+        self.writer = None
+        self.everyone = set()
+        self.occupants = {}
+        self.pending = {}
+
+    async def serve(self):
+        'Connect to the hub, and serve until it is gone'
+        reader, self.writer = await asyncio.open_unix_connection(
+            self.hub, limit=HUB_LIMIT)
+        serving = asyncio.ensure_future(ChatServer.serve(self))
+        def handle(op, **message):
+            getattr(self, 'on_' + op)(**message)
+        try:
+            await receive(reader, handle)
+        finally:
+            serving.cancel()
+
+    def claim(self, session, name):
+        # Ask the hub, unless we know the name is in use:
+        if name in self.everyone or name in self.pending:
+            self.refuse(session, name)
+        else:
+            self.pending[name] = session
+            send(self.writer, op='claim', name=name)
+
+    def logout(self, session):
+        if self.users.get(session.name) is session:
+            send(self.writer, op='release', name=session.name)
+        ChatServer.logout(self, session)
+
+    def entered(self, room, session):
+        # Our own users are counted at once, before the hub answers:
+        self.on_entered(room.name, session.name)
+        send(self.writer, op='enter', room=room.name, name=session.name)
+
+    def exited(self, room, session):
+        self.on_exited(room.name, session.name)
+        send(self.writer, op='exit', room=room.name, name=session.name)
+
+    def publish(self, room, line):
+        send(self.writer, op='say', room=room.name, line=line)
+
+    def names(self):
+        return sorted(self.everyone)
+
+    def members(self, room):
+        return sorted(self.occupants.get(room.name, ()))
+
+    def room_list(self):
+        return sorted((name, len(members))
+                      for name, members in self.occupants.items())
+
+    def on_claimed(self, name, ok):
+        session = self.pending.pop(name)
+        if not ok:
+            self.refuse(session, name)
+        elif session.transport.is_closing() or session.name is not None:
+            # The session is gone, or got another name meanwhile:
+            send(self.writer, op='release', name=name)
+        else:
+            self.login(session, name)
+
+    def on_joined(self, name):
+        self.everyone.add(name)
+
+    def on_left(self, name):
+        self.everyone.discard(name)
+
+    def on_entered(self, room, name):
+        self.occupants.setdefault(room, set()).add(name)
 
-    def handle_accept(self):
-        conn, addr = self.accept()
-        ChatSession(self, conn)
+    def on_exited(self, room, name):
+        members = self.occupants.get(room, set())
+        members.discard(name)
+        if not members: self.occupants.pop(room, None)
+
+    def on_say(self, room, line):
+        if room in self.rooms: self.rooms[room].deliver(line)
+
+def shard(port, name, hub):
+    'Runs a ShardServer (in a process of its own)'
+    try: asyncio.run(ShardServer(port, name, hub).serve())
+    except KeyboardInterrupt: pass
+
+def main(shards=1):
+    """
+    Runs a chat server, in one process, or in the given number of
+    ShardServer processes and a Hub (in this one).
+    """
+    if shards == 1:
+        asyncio.run(ChatServer(PORT, NAME).serve())
+        return
+    dirname = mkdtemp()
+    try:
+        # The hub listens before the shards start, so they can connect:
+        sock = socket.socket(socket.AF_UNIX)
+        sock.bind(join(dirname, 'hub'))
+        sock.listen(shards)
+        for i in range(shards):
+            Process(target=shard, args=(PORT, NAME, sock.getsockname()),
+                    daemon=True).start()
+        asyncio.run(Hub().serve(sock))
+    finally:
+        rmtree(dirname)
 
 if __name__ == '__main__':
-    s = ChatServer(PORT, NAME)
-    try: asyncore.loop()
-    except KeyboardInterrupt: print
\ No newline at end of file
+    # The number of processes may be given on the command line:
+    try: main(*map(int, sys.argv[1:]))
+    except KeyboardInterrupt: print()
\ No newline at end of file
@@ -0,0 +1,52 @@
+from chatserver import LineFramer
+from time import perf_counter
+import sys
+
+# Kinds of traffic: line length and bytes per read, in bytes:
+TRAFFIC = [('small', 40, 4096), ('large', 8000, 256)]
+MB = 1024 * 1024
+
+def chunks(length, size, total):
+    """
+    Returns the pieces of data a server would receive if it were sent
+    lines of the given length (plus "\r\n") adding up to about total
+    bytes, read size bytes at a time.
+    """
+    line = b'x' * length + b'\r\n'
+    data = line * max(1, total // len(line))
+    return [data[i:i+size] for i in range(0, len(data), size)]
+
+class Splitter:
+    """
+    The way the chat server used to split its data into lines: adding
+    each piece to what was left over, and splitting it all again.
+    """
+    def __init__(self):
+        self.data = b''
+
+    def feed(self, data):
+        lines = (self.data + data).split(b'\r\n')
+        self.data = lines.pop()
+        return lines
+
+def measure(framer, pieces):
+    'Feeds the pieces to a framer, and returns the lines per second'
+    start = perf_counter()
+    count = 0
+    for piece in pieces:
+        count += len(framer.feed(piece))
+    return count / max(perf_counter() - start, 1e-9)
+
+def main():
+    # The amount of data (in MB) may be given on the command line:
+    total = MB * int((sys.argv[1:] or [16])[0])
+    print('%-8s %8s %8s %-12s %14s' % ('Traffic', 'Line', 'Read',
+                                       'Framer', 'Lines/s'))
+    for name, length, size in TRAFFIC:
+        pieces = chunks(length, size, total)
+        for framer in Splitter, LineFramer:
+            rate = measure(framer(), pieces)
+            print('%-8s %8d %8d %-12s %14.0f' % (name, length, size,
+                                                 framer.__name__, rate))
+
+if __name__ == '__main__': main()
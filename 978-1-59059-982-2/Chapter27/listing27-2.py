@@ -1,14 +1,80 @@
-from xmlrpclib import ServerProxy, Fault
-from os.path import join, abspath, isfile
-from SimpleXMLRPCServer import SimpleXMLRPCServer
+from xmlrpclib import ServerProxy, Transport, Fault, Binary
+from os.path import join, abspath, isfile, getmtime, dirname
+from SimpleXMLRPCServer import SimpleXMLRPCServer, SimpleXMLRPCRequestHandler
+from SocketServer import TCPServer, StreamRequestHandler
 from urlparse import urlparse
-import sys
+from optparse import OptionParser
+from threading import Thread, Event, Lock, local
+from Queue import Queue, Empty
+from collections import OrderedDict, deque
+from uuid import uuid4
+from hashlib import sha1
+from time import time, sleep
+import sys, os, socket, select, struct, fnmatch, re, json, mmap, zlib
 
 SimpleXMLRPCServer.allow_reuse_address = 1
+TCPServer.allow_reuse_address = 1
 
-MAX_HISTORY_LENGTH = 6
+MAX_HOPS = 6 # Number of times a query may be passed on
+
+BLOCK_SIZE     = 256 * 1024  # Files are hashed and fetched in such blocks
+MAX_CHUNK_SIZE = 1024 * 1024 # Largest chunk a Node will hand out
+MAX_ATTEMPTS   = 3           # Times fetch tries to get a good block
+PARTIAL        = '.part'     # Suffix of files being downloaded
+MAX_SOURCES    = 8           # Nodes to download a file from at once
+SLOW_FACTOR    = 4           # How much slower than the best a source may be
+
+PEER_TIMEOUT = 5.0 # Seconds to wait for each other Node
+MAX_FANOUT   = 8   # Other Nodes asked at the same time in a broadcast
+
+PING_INTERVAL = 30.0    # Seconds between pings of the other Nodes
+INITIAL_RTT   = 0.1     # Round-trip time assumed for Nodes never pinged
+SMOOTHING     = 0.25    # Weight of new samples in moving averages
+BACKOFF       = 5.0     # Seconds to leave a Node alone after a failure...
+MAX_BACKOFF   = 600.0   # ...doubled for each failure in a row, up to this
+FORGET_AFTER  = 86400.0 # Seconds without an answer before a Node is dropped
+
+INDEX_INTERVAL = 1.0   # Seconds between checks for changes in the directory
+NEGATIVE_TTL   = 30.0  # Seconds to remember that a query failed
+ROUTE_TTL      = 300.0 # Seconds to remember which Node answered a query
+SEEN_TTL       = 60.0  # Seconds to remember the IDs of queries seen
+CACHE_SIZE     = 10000 # Maximum number of entries in such caches
+MAX_CHANGES    = 100   # Changes to the directory remembered by the index
+
+RELAY_CACHE_SIZE = 256 * 1024 * 1024 # Bytes kept in a relay cache
+CACHED_FILE_TTL  = 300.0 # Seconds a whole file is served from the cache
+
+# Upper bounds (in milliseconds) of the buckets of latency histograms:
+BUCKETS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000]
+STATS_INTERVAL = 60.0  # Seconds between dumps of the statistics to a file
+TRACE_TTL      = 600.0 # Seconds the spans of a query are kept for tracing
+SLOWEST        = 10    # Slowest recent queries listed in the statistics
+
+MAX_RESULTS = 1000  # Most names a search may return
+SEARCH_TTL  = 300.0 # Seconds the results of a search are kept
+
+MAX_WORKERS = 16 # Threads handling incoming requests
+MAX_BACKLOG = 64 # Accepted requests waiting for a free thread
+
+UPLOAD_RATE     = 0           # Bytes per second sent as uploads (0: any)
+UPLOAD_BURST    = 1024 * 1024 # Bytes that may be sent at once when idle
+PEER_SLOTS      = 2           # Uploads to the same peer at the same time
+CONTROL_WORKERS = 4           # Threads kept free for requests that aren't
+                              # uploads (so uploads can't crowd them out)
+
+KEEPALIVE = 2.0 # Seconds the server keeps an idle connection open
+MAX_IDLE  = 2   # Idle connections kept open to each other Node
+
+REQUEST_HEADER  = '!I'    # Length of a binary data request
+RESPONSE_HEADER = '!H8sI' # Fault code (0 for none), codec used (if any),
+                          # and length of the data
+
+SAMPLE_SIZE = 4096 # Bytes of a chunk compressed to see if it's worth it
+MIN_SAVING  = 0.1  # Fraction by which the sample must shrink
 
 UNHANDLED     = 100
+DUPLICATE     = 101
+BUSY          = 102
 ACCESS_DENIED = 200
 
 class UnhandledQuery(Fault):
@@ -18,6 +84,21 @@ class UnhandledQuery(Fault):
     def __init__(self, message="Couldn't handle the query"):
         Fault.__init__(self, UNHANDLED, message)
 
+class DuplicateQuery(Fault):
+    """
+    An exception that is raised when a Node drops a query because it
+    has already seen its ID.
+    """
+    def __init__(self, message="Query already seen"):
+        Fault.__init__(self, DUPLICATE, message)
+
+class Busy(Fault):
+    """
+    An exception that is raised when a Node turns down an upload
+    because it is already uploading as much as it will.
+    """
+    def __init__(self, message="Too many uploads"):
+        Fault.__init__(self, BUSY, message)
 
 class AccessDenied(Fault):
     """
@@ -27,6 +108,34 @@ class AccessDenied(Fault):
     def __init__(self, message="Access denied"):
         Fault.__init__(self, ACCESS_DENIED, message)
 
+# Information about the request being handled by the current thread:
+# the address of the peer, and what to do once the response is sent.
+context = local()
+
+# The codecs that may be used to compress chunks sent over the binary
+# data port, by name. Each is a pair of functions that compress and
+# decompress a string.
+CODECS = OrderedDict()
+
+def addCodec(name, compress, decompress):
+    """
+    Makes a codec available, under a name of at most eight characters
+    (the room for it in a RESPONSE_HEADER), without commas or spaces.
+    Nodes offer the codecs in the order they were added.
+    """
+    if len(name) > 8 or ',' in name or ' ' in name:
+        raise ValueError('Bad codec name: %r' % name)
+    CODECS[name] = compress, decompress
+
+addCodec('zlib', zlib.compress, zlib.decompress)
+
+def worthCompressing(sample, compress):
+    """
+    Checks whether data seems worth compressing, judging by how much a
+    sample of it shrinks. Data that is compressed already won't.
+    """
+    return len(compress(sample)) < len(sample) * (1 - MIN_SAVING)
+
 def inside(dir, name):
     """
     Checks whether a given file name lies within a given directory.
@@ -35,6 +144,25 @@ def inside(dir, name):
     name = abspath(name)
     return name.startswith(join(dir, ''))
 
+def inParallel(function, items, threads):
+    """
+    Calls a function with each of the given items, in up to the given
+    number of threads, and waits for all the calls to finish.
+    """
+    queue = Queue()
+    for item in items: queue.put(item)
+    def work():
+        while True:
+            try: item = queue.get_nowait()
+            except Empty: return
+            function(item)
+    workers = [Thread(target=work)
+               for i in range(min(threads, queue.qsize()))]
+    for t in workers:
+        t.setDaemon(1)
+        t.start()
+    for t in workers: t.join()
+
 def getPort(url):
     """
     Extracts the port number from a URL.
@@ -43,28 +171,1131 @@ def getPort(url):
     parts = name.split(':')
     return int(parts[-1])
 
+class ShareIndex:
+    """
+    An in-memory index of the names of the files in a directory. The
+    index is reloaded whenever the modification time of the directory
+    changes, which is checked at most once every interval seconds. Each
+    reload that changes the names gives the index a new version, and
+    the names added and removed in the last few versions are kept, so
+    that others can catch up without getting all the names again.
+    """
+    def __init__(self, dirname, interval=INDEX_INTERVAL,
+                 remember=MAX_CHANGES):
+        self.dirname = dirname
+        self.interval = interval
+        self.names = frozenset()
+        self.sorted = []
+        self.version = 0
+        self.changes = deque(maxlen=remember)
+        self.mtime = None
+        self.checked = 0
+        self.lock = Lock()
+
+    def __contains__(self, name):
+        # Only the top level is indexed; other names are looked up:
+        if dirname(name): return isfile(join(self.dirname, name))
+        self.refresh()
+        return name in self.names
+
+    def refresh(self, force=False):
+        'Reloads the index if the directory has changed'
+        with self.lock:
+            now = time()
+            if not force and now - self.checked < self.interval: return
+            self.checked = now
+            mtime = getmtime(self.dirname)
+            if not force and mtime == self.mtime: return
+            first = self.mtime is None
+            self.mtime = mtime
+            names = frozenset(name for name in os.listdir(self.dirname)
+                              if not name.endswith(PARTIAL)
+                              and isfile(join(self.dirname, name)))
+            if names == self.names: return
+            self.version += 1
+            # The first load isn't a change anyone can catch up with:
+            if not first:
+                self.changes.append((self.version, names - self.names,
+                                     self.names - names))
+            self.names = names
+            self.sorted = sorted(names)
+
+    def snapshot(self):
+        'Returns the current version and the names in sorted order'
+        self.refresh()
+        with self.lock: return self.version, self.sorted
+
+    def since(self, version):
+        """
+        Returns the current version, and the sets of names added and
+        removed since the given version. If the changes go back further
+        than the index remembers, the sets are None.
+        """
+        self.refresh()
+        with self.lock:
+            current, changes = self.version, list(self.changes)
+        if version == current: return current, set(), set()
+        if version > current or not changes or changes[0][0] > version + 1:
+            return current, None, None
+        added, removed = set(), set()
+        for v, plus, minus in changes:
+            if v <= version: continue
+            for name in plus:
+                if name in removed: removed.discard(name)
+                else: added.add(name)
+            for name in minus:
+                if name in added: added.discard(name)
+                else: removed.add(name)
+        return current, added, removed
+
+class ExpiringCache:
+    """
+    A simple cache whose entries expire after ttl seconds. If it grows
+    beyond size entries, the oldest ones are dropped.
+    """
+    def __init__(self, ttl, size=CACHE_SIZE):
+        self.ttl = ttl
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = Lock()
+
+    def get(self, key, default=None):
+        'Returns the value stored under key, if it has not expired'
+        with self.lock:
+            try: expires, value = self.entries[key]
+            except KeyError: return default
+            if expires < time():
+                del self.entries[key]
+                return default
+            return value
+
+    def put(self, key, value):
+        'Stores a value under key, replacing any earlier one'
+        with self.lock:
+            self._store(key, value)
+
+    def add(self, key, value=True):
+        """
+        Stores a value under key unless one is there already. Returns
+        whether the value was stored.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and entry[0] >= time(): return False
+            self._store(key, value)
+            return True
+
+    def increase(self, key, value):
+        """
+        Stores a value under key unless one at least as large is there
+        already. Returns whether the value was stored.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and entry[0] >= time() and entry[1] >= value:
+                return False
+            self._store(key, value)
+            return True
+
+    def _store(self, key, value):
+        self.entries.pop(key, None)
+        self.entries[key] = time() + self.ttl, value
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def discard(self, key):
+        'Removes any value stored under key'
+        with self.lock:
+            self.entries.pop(key, None)
+
+class Peer:
+    """
+    What a Node knows about another Node: its round-trip time and how
+    reliable it is (both moving averages), when it last answered, and
+    for how long it should be left alone after failing.
+    """
+    def __init__(self, url):
+        self.url = url
+        self.rtt = None
+        self.reliability = 1.0
+        self.successes = 0
+        self.failures = 0
+        self.strikes = 0
+        self.added = self.lastSeen = time()
+        self.retryAt = 0
+
+    def expected(self):
+        'Returns the expected time it takes to get an answer'
+        return (self.rtt or INITIAL_RTT) / max(self.reliability, 0.01)
+
+class PeerTable:
+    """
+    The other Nodes known to a Node. Nodes that fail are not forgotten
+    at once, but left alone for a while -- longer for each failure in a
+    row -- and only dropped when they haven't answered for FORGET_AFTER
+    seconds.
+    """
+    def __init__(self):
+        self.peers = {}
+        self.lock = Lock()
+
+    def __contains__(self, url):
+        return url in self.peers
+
+    def __len__(self):
+        return len(self.peers)
+
+    def __iter__(self):
+        return iter(self.peers.keys())
+
+    def add(self, url):
+        'Adds a Node to the table'
+        with self.lock:
+            if url not in self.peers: self.peers[url] = Peer(url)
+
+    def discard(self, url):
+        'Removes a Node from the table'
+        with self.lock:
+            self.peers.pop(url, None)
+
+    def ordered(self):
+        """
+        Returns the URLs of the Nodes that aren't being left alone, the
+        fastest (as far as we know) first.
+        """
+        now = time()
+        with self.lock:
+            peers = [peer for peer in self.peers.values()
+                     if peer.retryAt <= now]
+        peers.sort(key=Peer.expected)
+        return [peer.url for peer in peers]
+
+    def success(self, url, rtt=None):
+        'Records that a Node answered, possibly with its round-trip time'
+        with self.lock:
+            peer = self.peers.get(url)
+            if not peer: return
+            peer.successes += 1
+            peer.reliability += SMOOTHING * (1 - peer.reliability)
+            peer.strikes = 0
+            peer.lastSeen = time()
+            peer.retryAt = 0
+            if rtt is None: return
+            if peer.rtt is None: peer.rtt = rtt
+            else: peer.rtt += SMOOTHING * (rtt - peer.rtt)
+
+    def failure(self, url):
+        'Records that a Node failed to answer'
+        with self.lock:
+            peer = self.peers.get(url)
+            if not peer: return
+            now = time()
+            if now - peer.lastSeen > FORGET_AFTER:
+                del self.peers[url]
+                return
+            peer.failures += 1
+            peer.reliability -= SMOOTHING * peer.reliability
+            peer.strikes += 1
+            peer.retryAt = now + min(BACKOFF * 2 ** (peer.strikes - 1),
+                                     MAX_BACKOFF)
+
+    def status(self):
+        'Returns what is known about each Node, as a list of dictionaries'
+        with self.lock:
+            return [{'url': peer.url, 'rtt': peer.rtt or 0.0,
+                     'reliability': peer.reliability,
+                     'successes': peer.successes,
+                     'failures': peer.failures,
+                     'lastSeen': peer.lastSeen, 'retryAt': peer.retryAt}
+                    for peer in self.peers.values()]
+
+class TimeoutTransport(Transport):
+    """
+    An XML-RPC transport whose connections give up after a given
+    number of seconds.
+    """
+    def __init__(self, timeout):
+        Transport.__init__(self)
+        self.timeout = timeout
+
+    def make_connection(self, host):
+        conn = Transport.make_connection(self, host)
+        conn.timeout = self.timeout
+        return conn
+
+class PeerPool:
+    """
+    A pool of open XML-RPC connections to other Nodes, so that calls
+    to the same Node can reuse a connection instead of setting up a new
+    one each time. Connections are thrown away when they have been idle
+    for too long (the server will have closed them), and when a call
+    fails, along with all other connections to the same Node.
+    """
+    def __init__(self, timeout=PEER_TIMEOUT, idle=MAX_IDLE,
+                 keepalive=KEEPALIVE):
+        self.timeout = timeout
+        self.idle = idle
+        self.keepalive = keepalive
+        self.transports = {}
+        self.lock = Lock()
+
+    def call(self, url, method, *args):
+        'Calls a method on the Node with the given URL'
+        transport = self._get(url)
+        try:
+            result = getattr(ServerProxy(url, transport), method)(*args)
+        except Fault:
+            # The call failed, but the connection is fine:
+            self._put(url, transport)
+            raise
+        except:
+            transport.close()
+            self.evict(url)
+            raise
+        self._put(url, transport)
+        return result
+
+    def proxy(self, url):
+        'Returns a ServerProxy-like object that makes calls through the pool'
+        return PooledProxy(self, url)
+
+    def evict(self, url):
+        'Closes all idle connections to the Node with the given URL'
+        with self.lock:
+            idle = self.transports.pop(url, [])
+        for used, transport in idle:
+            transport.close()
+
+    def _get(self, url):
+        with self.lock:
+            idle = self.transports.get(url, [])
+            while idle:
+                used, transport = idle.pop()
+                if time() - used < self.keepalive * 0.75: return transport
+                transport.close()
+        return TimeoutTransport(self.timeout)
+
+    def _put(self, url, transport):
+        with self.lock:
+            idle = self.transports.setdefault(url, [])
+            if len(idle) < self.idle:
+                idle.append((time(), transport))
+                return
+        transport.close()
+
+class PooledProxy(object):
+    """
+    Stands in for a ServerProxy, but makes its calls through a PeerPool.
+    """
+    def __init__(self, pool, url):
+        self.pool = pool
+        self.url = url
+
+    def __getattr__(self, name):
+        def call(*args):
+            return self.pool.call(self.url, name, *args)
+        return call
+
+class KeepAliveRequestHandler(SimpleXMLRPCRequestHandler):
+    """
+    A request handler that uses HTTP/1.1, so clients can send several
+    requests over the same connection. It handles a single request, and
+    leaves waiting for the next one to the server (see PooledMixIn), so
+    an idle connection doesn't tie up a worker thread.
+    """
+    protocol_version = 'HTTP/1.1'
+    timeout = KEEPALIVE
+
+    def handle(self):
+        self.close_connection = 1
+        self.handle_one_request()
+        self.keepOpen = not self.close_connection
+
+    def log_error(self, format, *args):
+        # Clients that go quiet in the middle of a request are dropped,
+        # but that's nothing to report:
+        if format.startswith('Request timed out'): return
+        SimpleXMLRPCRequestHandler.log_error(self, format, *args)
+
+def readable(files, timeout):
+    """
+    Waits up to timeout seconds for some of the given files (sockets,
+    or file descriptors) to have something to read, and returns those.
+    Uses poll where there is one, since select can't take file
+    descriptors of FD_SETSIZE or more.
+    """
+    if not hasattr(select, 'poll'):
+        return select.select(files, [], [], timeout)[0]
+    poller = select.poll()
+    byFd = {}
+    for f in files:
+        if isinstance(f, int): fd = f
+        else: fd = f.fileno()
+        byFd[fd] = f
+        poller.register(fd, select.POLLIN)
+    return [byFd[fd] for fd, event in poller.poll(timeout * 1000)]
+
+class PooledMixIn:
+    """
+    A mix-in for servers that handle requests in a fixed number of
+    worker threads. Accepted requests wait in a queue of limited size;
+    while it is full, no new connections are accepted, so the clients
+    are held back until the server catches up.
+
+    If the request handler sets its keepOpen attribute, the connection
+    is kept open once the request has been handled, without tying up a
+    worker: a thread of its own watches all such idle connections, and
+    queues each of them again when the next request comes in, or closes
+    it after KEEPALIVE seconds.
+    """
+    def startWorkers(self, workers=MAX_WORKERS, backlog=MAX_BACKLOG):
+        'Starts the worker threads, and the one watching idle connections'
+        self.workers = workers
+        self.requests = Queue(backlog)
+        self.busy = 0
+        self.lock = Lock()
+        self.idle = {}
+        self.wakeup = os.pipe()
+        for target in [self.watch] + [self.work] * workers:
+            t = Thread(target=target)
+            t.setDaemon(1)
+            t.start()
+
+    def process_request(self, request, client_address):
+        # Blocks while the queue is full:
+        self.requests.put((request, client_address))
+
+    def finish_request(self, request, client_address):
+        'Handles a request, and returns whether to keep the connection open'
+        handler = self.RequestHandlerClass(request, client_address, self)
+        return getattr(handler, 'keepOpen', False)
+
+    def handle_error(self, request, client_address):
+        # Clients hanging up (when they time out, say) are nothing to
+        # report either:
+        if isinstance(sys.exc_info()[1], socket.error): return
+        TCPServer.handle_error(self, request, client_address)
+
+    def work(self):
+        'Handles queued requests, one at a time'
+        while True:
+            request, client_address = self.requests.get()
+            with self.lock: self.busy += 1
+            context.peer = client_address[0]
+            context.sent = []
+            keepOpen = False
+            try:
+                keepOpen = self.finish_request(request, client_address)
+            except:
+                self.handle_error(request, client_address)
+            context.peer = None
+            for callback in context.sent: callback()
+            if keepOpen: self.wait(request, client_address)
+            else: self.shutdown_request(request)
+            with self.lock: self.busy -= 1
+
+    def wait(self, request, client_address):
+        'Has the next request on a connection waited for in the background'
+        with self.lock:
+            self.idle[request] = client_address, time() + KEEPALIVE
+        os.write(self.wakeup[1], '.')
+
+    def watch(self):
+        """
+        Queues the idle connections on which a request comes in (or which
+        the client closes), and closes the ones idle for too long.
+        """
+        while True:
+            with self.lock: waiting = self.idle.keys()
+            try:
+                ready = readable(waiting + [self.wakeup[0]], KEEPALIVE / 2)
+            except (select.error, ValueError):
+                # Rather than stop watching, give up the idle connections:
+                with self.lock:
+                    for request in waiting: self.idle.pop(request, None)
+                for request in waiting: self.shutdown_request(request)
+                continue
+            if self.wakeup[0] in ready:
+                os.read(self.wakeup[0], 4096)
+                ready.remove(self.wakeup[0])
+            now = time()
+            with self.lock:
+                ready = [(request, self.idle.pop(request)[0])
+                         for request in ready]
+                expired = [request for request, (address, deadline)
+                           in self.idle.items() if deadline < now]
+                for request in expired: del self.idle[request]
+            for request in expired: self.shutdown_request(request)
+            for item in ready: self.requests.put(item)
+
+    def load(self):
+        'Returns the number of busy workers and of queued requests'
+        return self.busy, self.requests.qsize()
+
+class PooledXMLRPCServer(PooledMixIn, SimpleXMLRPCServer):
+    """
+    An XML-RPC server with a fixed number of worker threads.
+    """
+    def __init__(self, addr, workers=MAX_WORKERS, backlog=MAX_BACKLOG,
+                 requestHandler=KeepAliveRequestHandler, **kwds):
+        SimpleXMLRPCServer.__init__(self, addr, requestHandler, **kwds)
+        self.startWorkers(workers, backlog)
+
+class DataRequestHandler(StreamRequestHandler):
+    """
+    Serves chunks of a Node's local files over a plain connection,
+    without the overhead of XML-RPC. Each request is a REQUEST_HEADER
+    followed by the offset, length, content hash, the codecs the client
+    accepts (separated by commas) and file name, separated by spaces.
+    Each response is a RESPONSE_HEADER followed by the chunk (or by the
+    fault message, if the fault code isn't 0). Several requests may be
+    sent over the same connection; each is handled on its own (see
+    PooledMixIn).
+
+    If the client accepts a codec the server has, and a sample of the
+    file shows that it is worth it, the chunk is compressed with the
+    first such codec. Otherwise, unless zeroCopy is false, the chunk is
+    sent straight from the file to the socket, without being read into a
+    string first.
+    """
+    timeout = KEEPALIVE
+    zeroCopy = True
+
+    def handle(self):
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        try: request = readFrame(self.rfile, REQUEST_HEADER)[-1]
+        except (EOFError, socket.timeout): return
+        offset, length, hash, codecs, query = request.split(' ', 4)
+        codec = ''
+        try:
+            node = self.server.node
+            code, data = 0, node._upload(node._chunk, query, int(offset),
+                                         int(length), hash)
+            codec, data = self.compress(data, codecs.split(','))
+        except Fault, f:
+            code, data = f.faultCode, f.faultString
+        except Exception, e:
+            code, data = 1, str(e)
+        header = struct.pack(RESPONSE_HEADER, code, codec, len(data))
+        if isinstance(data, str):
+            self.wfile.write(header + data)
+        elif self.zeroCopy:
+            self.wfile.write(header)
+            data.sendTo(self.request)
+        else:
+            self.wfile.write(header + data.read())
+        self.keepOpen = True
+
+    def compress(self, chunk, accepted):
+        """
+        Compresses a chunk with the first of the accepted codecs the
+        server has, if it's worth it. Returns the name of the codec and
+        the compressed data, or an empty name and the chunk itself.
+        """
+        for name in accepted:
+            if name not in CODECS: continue
+            compress = CODECS[name][0]
+            if not self.server.node._compressible(chunk, name): break
+            data = chunk.read()
+            compressed = compress(data)
+            if len(compressed) >= len(data): break
+            self.server.node.metrics.count('compressionSaved',
+                                           len(data) - len(compressed))
+            return name, compressed
+        return '', chunk
+
+class Chunk:
+    """
+    A chunk of a local file, which can be read into a string, or sent
+    straight to a socket: with socket.sendfile (and so os.sendfile) if
+    there is one, so the data never passes through Python at all, or
+    else from a memory map of the file, so it isn't copied into a string
+    first.
+    """
+    def __init__(self, name, offset, length):
+        size = os.path.getsize(name)
+        self.name = name
+        self.offset = min(offset, size)
+        self.length = max(0, min(length, size - self.offset))
+
+    def __len__(self):
+        return self.length
+
+    def read(self):
+        'Returns the chunk as a string'
+        return self.sample(self.length)
+
+    def sample(self, size):
+        'Returns (at most) size bytes from the middle of the chunk'
+        size = min(size, self.length)
+        f = open(self.name, 'rb')
+        try:
+            f.seek(self.offset + (self.length - size) / 2)
+            return f.read(size)
+        finally:
+            f.close()
+
+    def sendTo(self, sock):
+        'Sends the chunk to a socket'
+        if not self.length: return
+        f = open(self.name, 'rb')
+        try:
+            if hasattr(sock, 'sendfile'):
+                sock.sendfile(f, self.offset, self.length)
+                return
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try: sock.sendall(buffer(m, self.offset, self.length))
+            finally: m.close()
+        finally:
+            f.close()
+
+class DataServer(PooledMixIn, TCPServer):
+    """
+    A server for a Node's binary data port, with a fixed number of
+    worker threads.
+    """
+    def __init__(self, addr, node, workers=MAX_WORKERS,
+                 backlog=MAX_BACKLOG):
+        TCPServer.__init__(self, addr, DataRequestHandler)
+        self.node = node
+        self.startWorkers(workers, backlog)
+
+class DataConnection:
+    """
+    A connection to the binary data port of another Node. The other Node
+    may compress the chunks it sends with any of the given codecs.
+    """
+    def __init__(self, url, port, timeout=PEER_TIMEOUT, codecs=None):
+        if codecs is None: codecs = CODECS.keys()
+        self.codecs = ','.join(codecs)
+        host = urlparse(url)[1].split(':')[0]
+        self.sock = socket.create_connection((host, port), timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.file = self.sock.makefile('rb')
+
+    def chunk(self, query, offset, length, hash=''):
+        """
+        Asks for a chunk of a file that the other Node has locally.
+        Returns the chunk as a string.
+        """
+        if isinstance(query, unicode): query = query.encode('utf-8')
+        request = '%d %d %s %s %s' % (offset, length, hash, self.codecs,
+                                      query)
+        self.sock.sendall(struct.pack(REQUEST_HEADER, len(request)) +
+                          request)
+        code, codec, data = readFrame(self.file, RESPONSE_HEADER)
+        if code: raise Fault(code, data)
+        codec = codec.rstrip('\0')
+        if codec: data = CODECS[codec][1](data)
+        return data
+
+    def close(self):
+        self.file.close()
+        self.sock.close()
+
+def readFrame(file, header):
+    """
+    Reads a frame, that is, a header ending with a length, followed by
+    that many bytes, from a file. Returns the other fields of the header
+    (if any) and the bytes. Raises EOFError if the file ends first.
+    """
+    size = struct.calcsize(header)
+    fields = file.read(size)
+    if len(fields) < size: raise EOFError
+    fields = struct.unpack(header, fields)
+    data = file.read(fields[-1])
+    if len(data) < fields[-1]: raise EOFError
+    return fields[:-1] + (data,)
+
+class RelayCache:
+    """
+    A cache, on disk, of the file contents a Node has passed on from
+    other Nodes, so it can answer repeated requests for them itself.
+    Each entry is kept in a file named after the hash of its key. When
+    the entries take up more than size bytes, the least recently used
+    ones are thrown out. An entry may be given a time to live when it is
+    looked up, which is checked against the modification time of its
+    file. Also counts hits and misses, and the bytes served from it.
+    Files in the directory that aren't the cache's own are left alone.
+    """
+    ENTRY = re.compile('[0-9a-f]{40}$')
+    TEMP  = re.compile('[0-9a-f]{40}\.[0-9a-f]{32}$')
+
+    def __init__(self, dirname, size=RELAY_CACHE_SIZE):
+        self.dirname = dirname
+        self.size = size
+        self.entries = OrderedDict()
+        self.used = 0
+        # Bytes are counted as a float, past XML-RPC's 32-bit integers:
+        self.counters = {'hits': 0, 'misses': 0, 'bytesSaved': 0.0,
+                         'stored': 0, 'evicted': 0}
+        self.lock = Lock()
+        if not os.path.isdir(dirname): os.makedirs(dirname)
+        # Entries left from earlier runs are kept, oldest first:
+        files = []
+        for name in os.listdir(dirname):
+            path = join(dirname, name)
+            if self.TEMP.match(name): os.remove(path) # Unfinished
+            elif self.ENTRY.match(name): files.append((getmtime(path), name))
+        for mtime, name in sorted(files):
+            size = os.path.getsize(join(dirname, name))
+            self.entries[name] = size
+            self.used += size
+        with self.lock: self._evict()
+
+    def get(self, key, ttl=None):
+        """
+        Returns the data stored under key, or None if there isn't any
+        (or it is more than ttl seconds old).
+        """
+        name = self._name(key)
+        path = join(self.dirname, name)
+        with self.lock:
+            found = name in self.entries
+            if found and ttl is not None and time() - getmtime(path) > ttl:
+                self._remove(name)
+                found = False
+            if not found:
+                self.counters['misses'] += 1
+                return None
+            self.entries[name] = self.entries.pop(name)
+        try:
+            f = open(path, 'rb')
+            try: data = f.read()
+            finally: f.close()
+        except IOError:
+            # Thrown out in the meantime:
+            with self.lock: self.counters['misses'] += 1
+            return None
+        with self.lock:
+            self.counters['hits'] += 1
+            self.counters['bytesSaved'] += len(data)
+        return data
+
+    def put(self, key, data):
+        'Stores data under key, throwing out old entries if need be'
+        if isinstance(data, unicode): data = data.encode('utf-8')
+        if len(data) > self.size: return
+        name = self._name(key)
+        path = join(self.dirname, name)
+        temp = '%s.%s' % (path, uuid4().hex)
+        f = open(temp, 'wb')
+        try: f.write(data)
+        finally: f.close()
+        os.rename(temp, path)
+        with self.lock:
+            self.used -= self.entries.pop(name, 0)
+            self.entries[name] = len(data)
+            self.used += len(data)
+            self.counters['stored'] += 1
+            self._evict()
+
+    def status(self):
+        """
+        Returns the counters, along with the hit ratio, the number of
+        entries, and the bytes they take up and may take up (as floats).
+        """
+        with self.lock:
+            status = dict(self.counters)
+            lookups = status['hits'] + status['misses']
+            status.update(ratio=float(status['hits']) / max(lookups, 1),
+                          entries=len(self.entries),
+                          used=float(self.used), size=float(self.size))
+        return status
+
+    def _name(self, key):
+        if isinstance(key, unicode): key = key.encode('utf-8')
+        return sha1(key).hexdigest()
+
+    def _evict(self):
+        while self.used > self.size:
+            name = next(iter(self.entries))
+            self._remove(name)
+            self.counters['evicted'] += 1
+
+    def _remove(self, name):
+        self.used -= self.entries.pop(name)
+        try: os.remove(join(self.dirname, name))
+        except OSError: pass
+
+class TokenBucket:
+    """
+    Limits the rate of something (such as bytes sent) to rate units per
+    second, with bursts of up to burst units after a quiet period. A
+    rate of 0 means no limit.
+    """
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time()
+        self.lock = Lock()
+
+    def take(self, amount):
+        """
+        Takes an amount out of the bucket, first waiting for it to fill
+        up enough if need be. Returns the number of seconds waited.
+        """
+        if not self.rate: return 0.0
+        with self.lock:
+            now = time()
+            self.tokens = min(self.burst, self.tokens +
+                              (now - self.updated) * self.rate)
+            self.updated = now
+            # Going into debt makes those who come later wait longer:
+            self.tokens -= amount
+            if self.tokens >= 0: return 0.0
+            wait = -self.tokens / float(self.rate)
+        sleep(wait)
+        return wait
+
+class Uploads:
+    """
+    Keeps a Node's uploads (the requests for file contents) in check:
+    no more than slots at a time to the same peer, no more than bulk at
+    a time in all, so the rest of the worker threads are left for the
+    smaller requests, and no more bytes per second than the token bucket
+    allows. Also counts what has been uploaded and turned down.
+    """
+    def __init__(self, rate, burst, slots, bulk):
+        self.bucket = TokenBucket(rate, burst)
+        self.slots = slots
+        self.bulk = bulk
+        self.active = {}
+        self.total = 0
+        # Bytes are counted as a float, past XML-RPC's 32-bit integers:
+        self.counters = {'uploads': 0, 'bytes': 0.0, 'peerBusy': 0,
+                         'bulkBusy': 0, 'throttled': 0, 'waited': 0.0}
+        self.lock = Lock()
+
+    def start(self, peer):
+        'Starts an upload to a peer, unless too many are going on'
+        with self.lock:
+            if self.total >= self.bulk:
+                self.counters['bulkBusy'] += 1
+                raise Busy
+            if self.active.get(peer, 0) >= self.slots:
+                self.counters['peerBusy'] += 1
+                raise Busy('Too many uploads to you')
+            self.active[peer] = self.active.get(peer, 0) + 1
+            self.total += 1
+
+    def send(self, bytes):
+        'Waits until a number of bytes may be sent'
+        waited = self.bucket.take(bytes)
+        with self.lock:
+            self.counters['bytes'] += bytes
+            if waited:
+                self.counters['throttled'] += 1
+                self.counters['waited'] += waited
+
+    def finish(self, peer):
+        'Records that an upload to a peer is over'
+        with self.lock:
+            self.counters['uploads'] += 1
+            self.total -= 1
+            self.active[peer] -= 1
+            if not self.active[peer]: del self.active[peer]
+
+    def status(self):
+        """
+        Returns the counters, along with the limits and the number of
+        uploads going on.
+        """
+        with self.lock:
+            status = dict(self.counters)
+            status.update(rate=float(self.bucket.rate),
+                          burst=float(self.bucket.burst),
+                          slots=self.slots, bulk=self.bulk,
+                          active=self.total, peers=len(self.active))
+        return status
+
+class Transfer:
+    """
+    The progress of a download: how many bytes of the file are done
+    (including any resumed from a partial file), and how fast the rest
+    has been coming in.
+    """
+    def __init__(self, name, size, done):
+        self.name = name
+        self.size = size
+        self.done = done
+        self.received = 0
+        self.started = time()
+        self.lock = Lock()
+
+    def add(self, bytes):
+        'Records that a number of bytes have come in'
+        with self.lock:
+            self.done += bytes
+            self.received += bytes
+
+    def status(self):
+        """
+        Returns the progress as a dictionary with the name and size of
+        the file, the bytes done, the rate in bytes per second, and the
+        estimated number of seconds left (or -1 if it can't be told).
+        """
+        rate = self.received / max(time() - self.started, 1e-6)
+        eta = -1.0
+        if rate: eta = (self.size - self.done) / rate
+        return {'name': self.name, 'size': self.size, 'done': self.done,
+                'rate': rate, 'eta': eta}
+
+class Search:
+    """
+    The results of a search: the names found so far, each only once and
+    in the order they came in, up to a limit. A search that is going on
+    in the background can be read while the results come in.
+    """
+    def __init__(self, limit):
+        self.limit = limit
+        self.names = []
+        self.found = set()
+        self.done = False
+        self.lock = Lock()
+
+    def add(self, names):
+        'Adds the names that haven\'t been found yet, up to the limit'
+        with self.lock:
+            for name in names:
+                if len(self.names) >= self.limit: break
+                if name in self.found: continue
+                self.found.add(name)
+                self.names.append(name)
+
+    def full(self):
+        'Checks whether the limit has been reached'
+        return len(self.names) >= self.limit
+
+    def read(self, start):
+        """
+        Returns the names found after the first start ones, and whether
+        the search is over.
+        """
+        with self.lock:
+            return {'names': self.names[start:], 'done': self.done}
+
+class Histogram:
+    """
+    A histogram of durations, counted in buckets whose upper bounds (in
+    milliseconds) are given by BUCKETS, plus one for anything longer.
+    """
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        'Counts a duration'
+        ms = seconds * 1000
+        i = 0
+        while i < len(BUCKETS) and ms > BUCKETS[i]: i += 1
+        self.counts[i] += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def percentile(self, p):
+        """
+        Returns (the upper bound of the bucket of) the duration that the
+        given percentage of the durations don't exceed, in seconds.
+        """
+        wanted = sum(self.counts) * p / 100.0
+        seen = 0
+        for bound, count in zip(BUCKETS, self.counts):
+            seen += count
+            if seen >= wanted: return bound / 1000.0
+        return self.max
+
+    def status(self):
+        """
+        Returns the number, mean, maximum, median and 99th percentile of
+        the durations (in seconds), and the bucket counts.
+        """
+        count = sum(self.counts)
+        return {'count': count, 'mean': self.total / max(count, 1),
+                'max': self.max, 'p50': self.percentile(50),
+                'p99': self.percentile(99), 'buckets': self.counts}
+
+class Metrics:
+    """
+    Counters and latency histograms, updated by several threads.
+    """
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        self.lock = Lock()
+
+    def count(self, name, amount=1):
+        'Adds an amount to a counter'
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def record(self, name, seconds):
+        'Counts a duration in a histogram'
+        with self.lock:
+            if name not in self.histograms:
+                self.histograms[name] = Histogram()
+            self.histograms[name].record(seconds)
+
+    def status(self):
+        """
+        Returns the counters and the status of the histograms. Counters
+        of bytes soon outgrow XML-RPC's 32-bit integers, so the counters
+        are returned as floats.
+        """
+        with self.lock:
+            return {'counters': dict((name, float(value)) for name, value
+                                     in self.counters.items()),
+                    'latency': dict((name, h.status()) for name, h
+                                    in self.histograms.items()),
+                    'buckets': BUCKETS}
+
 class Node:
     """
     A node in a peer-to-peer network.
     """
-    def __init__(self, url, dirname, secret):
+    # Methods that may pass a query on to other Nodes, and so may take
+    # as long to answer as the timeout even when all is well:
+    relayed = ('query', 'queryInfo', 'queryChunk', 'locate', 'search',
+               'trace')
+
+    def __init__(self, url, dirname, secret, timeout=PEER_TIMEOUT,
+                 fanout=MAX_FANOUT, workers=MAX_WORKERS, dataPort=0,
+                 uploadRate=UPLOAD_RATE, cacheDir=None,
+                 cacheSize=RELAY_CACHE_SIZE, statsFile=None):
         self.url = url
         self.dirname = dirname
         self.secret = secret
-        self.known = set()
+        self.timeout = timeout
+        self.fanout = fanout
+        self.workers = workers
+        self.dataPort = dataPort
+        self.server = None
+        self.pool = PeerPool(timeout)
+        self.known = PeerTable()
+        self.index = ShareIndex(dirname)
+        self.misses = ExpiringCache(NEGATIVE_TTL)
+        self.routes = ExpiringCache(ROUTE_TTL)
+        self.seen = ExpiringCache(SEEN_TTL)
+        self.hashes = {}
+        self.compressible = {}
+        self.transfers = {}
+        self.searches = ExpiringCache(SEARCH_TTL)
+        self.uploads = Uploads(uploadRate, UPLOAD_BURST, PEER_SLOTS,
+                               max(1, workers - CONTROL_WORKERS))
+        self.cache = None
+        if cacheDir:
+            if abspath(cacheDir) == abspath(dirname):
+                raise ValueError('The relay cache needs its own directory')
+            self.cache = RelayCache(cacheDir, cacheSize)
+        self.statsFile = statsFile
+        self.metrics = Metrics()
+        self.traces = ExpiringCache(TRACE_TTL)
+        self.recent = deque(maxlen=CACHE_SIZE)
 
-    def query(self, query, history=[]):
+    def query(self, query, qid='', hops=MAX_HOPS):
         """
         Performs a query for a file, possibly asking other known Nodes for
-        help. Returns the file as a string.
+        help. Returns the file as a string. The query ID (qid) is used by
+        the Nodes to recognize queries they have already seen; it is
+        generated by the first Node, as is the hop count.
+        """
+        return self._ask(self._handle, 'query', query, (), qid, hops)
+
+    def queryInfo(self, query, qid='', hops=MAX_HOPS):
+        """
+        Like query, but returns information about the file rather than
+        the file itself: a dictionary with its size, the SHA-1 hash of its
+        contents, and the hashes of each of its blocks of BLOCK_SIZE bytes.
+        """
+        return self._ask(self._handleInfo, 'queryInfo', query, (),
+                         qid, hops)
+
+    def queryChunk(self, query, offset, length, hash='', qid='',
+                   hops=MAX_HOPS):
+        """
+        Like query, but returns only (at most) length bytes of the file,
+        starting at offset, as an xmlrpclib.Binary. If a hash is given,
+        only a file with exactly those contents will do.
+        """
+        return self._ask(self._handleChunk, 'queryChunk', query,
+                         (offset, length, hash), qid, hops)
+
+    def locate(self, query, hash='', qid='', hops=MAX_HOPS):
+        """
+        Finds all the Nodes (within reach) that have the given file, with
+        the given contents if a hash is given. Unlike query, this asks
+        all the known Nodes, and returns a list of the URLs of all the
+        Nodes that have it.
         """
+        qid = self._see(qid, hops)
+        holders = []
         try:
-            return self._handle(query)
+            name = self._local(query)
+            if not hash or self._info(name)['hash'] == hash:
+                holders.append(self.url)
         except UnhandledQuery:
-            history = history + [self.url]
-            if len(history) >= MAX_HISTORY_LENGTH: raise
-            return self._broadcast(query, history)
+            pass
+        if hops > 0:
+            holders.extend(self._gather('locate', query, (hash,), qid, hops))
+        return list(set(holders))
 
+    def search(self, pattern, limit=MAX_RESULTS, qid='', hops=MAX_HOPS):
+        """
+        Finds the names of the files (within reach) that match a
+        shell-style pattern such as '*.txt'. Like locate, this asks all
+        the known Nodes (unless the limit is reached first), but each
+        name is returned only once, and no more than limit of them (or
+        MAX_RESULTS) in all.
+        """
+        search = Search(min(limit, MAX_RESULTS))
+        self._search(search, pattern, qid, hops)
+        return search.names
+
+    def startSearch(self, pattern, limit=MAX_RESULTS):
+        """
+        Starts a search (like the search method) in the background, and
+        returns its ID. The results can be read with the results method
+        as they come in from the other Nodes.
+        """
+        sid = uuid4().hex
+        search = Search(min(limit, MAX_RESULTS))
+        self.searches.put(sid, search)
+        def run():
+            try: self._search(search, pattern, '', MAX_HOPS)
+            finally: search.done = True
+        t = Thread(target=run)
+        t.setDaemon(1)
+        t.start()
+        return sid
+
+    def results(self, sid, start=0):
+        """
+        Returns the results of a search started with startSearch: a
+        dictionary with the names found after the first start ones, and
+        whether the search is over.
+        """
+        search = self.searches.get(sid)
+        if search is None: raise UnhandledQuery('No such search')
+        return search.read(start)
+
+    def load(self):
+        """
+        Reports how busy the Node's server is: the number of worker
+        threads, how many of them are busy, and the number of requests
+        queued up waiting for one.
+        """
+        busy, queued = self.server.load()
+        return {'workers': self.server.workers, 'busy': busy,
+                'queued': queued}
+
+    def getDataPort(self):
+        """
+        Returns the number of the Node's binary data port, or 0 if it
+        doesn't have one.
+        """
+        return self.dataPort or 0
 
     def hello(self, other):
         """
@@ -73,55 +1304,694 @@ class Node:
         self.known.add(other)
         return 0
 
+    def ping(self):
+        """
+        Used by other Nodes to check that the Node is alive.
+        """
+        return 0
+
+    def peers(self):
+        """
+        Returns what the Node knows about the other Nodes: for each of
+        them, a dictionary with its URL, round-trip time, reliability,
+        number of successes and failures, when it was last seen, and
+        when it will be contacted again (if it is being left alone).
+        """
+        return self.known.status()
+
+    def uploadStatus(self):
+        """
+        Returns the limits on the Node's uploads, and counters showing
+        how many uploads and bytes it has sent, how many uploads it has
+        turned down (because a peer had too many, or because too many
+        were going on), and how often and for how long (in seconds) it
+        has held uploads back to keep within the rate.
+        """
+        return self.uploads.status()
+
+    def cacheStatus(self):
+        """
+        Returns the statistics of the Node's relay cache: hits, misses,
+        the hit ratio, the bytes served from the cache instead of being
+        fetched again, entries stored and evicted, and the number and
+        total size of the entries. Empty if the Node has no cache.
+        """
+        if self.cache is None: return {}
+        return self.cache.status()
+
+    def stats(self):
+        """
+        Returns statistics about what the Node has been doing: counters
+        (of queries answered locally, from the cache or by other Nodes,
+        unhandled and duplicate queries, bytes served and fetched, and
+        so on), latency histograms (for each query method, for handling
+        queries locally, for broadcasts and for fetches), what it knows
+        about the other Nodes, the status of its uploads and relay cache,
+        and the slowest of the recent queries it started.
+        """
+        stats = self.metrics.status()
+        recent = sorted(self.recent, key=lambda span: -span['time'])
+        stats.update(peers=self.known.status(), uploads=self.uploads.status(),
+                     cache=self.cacheStatus(), slowest=recent[:SLOWEST])
+        return stats
+
+    def trace(self, qid, hops=MAX_HOPS):
+        """
+        Returns the spans recorded for a query ID (as listed by stats)
+        by this Node and by those it passed the query on to, along the
+        path the answer came back. Each span is a dictionary with the
+        URL of the Node, the method and query, the hops left, when the
+        query arrived, how long the Node took, the outcome (local,
+        cached, relayed or unhandled), and the Node it came back from
+        (via).
+        """
+        spans = list(self.traces.get(qid, []))
+        if hops > 0:
+            for span in list(spans):
+                if not span['via']: continue
+                try:
+                    spans.extend(self._call(span['via'], 'trace', qid,
+                                            hops - 1))
+                except:
+                    pass
+        return spans
+
+    def progress(self):
+        """
+        Returns the progress of the downloads going on: for each of them,
+        a dictionary with the name and size of the file, the bytes done,
+        the rate in bytes per second, and the estimated seconds left.
+        """
+        return [t.status() for t in self.transfers.values()]
+
     def fetch(self, query, secret):
         """
-        Used to make the Node find a file and download it.
+        Used to make the Node find a file and download it. The file is
+        identified by the hash of its contents and downloaded in blocks
+        into a partial file named after that hash, which is renamed once
+        the download is complete. The blocks are downloaded from all the
+        Nodes that have the file at once, and each block is checked
+        against its own hash, so an interrupted download can be resumed
+        by fetching just the blocks that are missing.
         """
         if secret != self.secret: raise AccessDenied
-        result = self.query(query)
-        f = open(join(self.dirname, query), 'w')
-        f.write(result)
-        f.close()
+        # From here on, the Node's calls are made on its own behalf:
+        context.peer = None
+        start = time()
+        try:
+            self._fetch(query)
+        finally:
+            self.metrics.record('fetch', time() - start)
         return 0
 
+    def _fetch(self, query):
+        """
+        Used internally to download a file (see fetch).
+        """
+        info = self.queryInfo(query)
+        name = join(self.dirname, query)
+        partial = '%s.%s%s' % (name, info['hash'], PARTIAL)
+        if isfile(partial): f = open(partial, 'r+b')
+        else: f = open(partial, 'w+b')
+        try:
+            missing = self._resume(f, info)
+            size = info['size']
+            done = size - sum(min(BLOCK_SIZE, size - i * BLOCK_SIZE)
+                              for i in missing)
+            transfer = Transfer(query, size, done)
+            self.transfers[query] = transfer
+            f.truncate(size)
+            holders = [other for other in self.locate(query, info['hash'])
+                       if other != self.url]
+            missing = self._swarm(f, query, info, missing,
+                                  holders[:MAX_SOURCES])
+            # Whatever the swarm couldn't get is asked for as usual:
+            for i in missing:
+                f.seek(i * BLOCK_SIZE)
+                data = self._fetchBlock(query, info, i)
+                f.write(data)
+                transfer.add(len(data))
+        finally:
+            self.transfers.pop(query, None)
+            f.close()
+        if isfile(name): os.remove(name)
+        os.rename(partial, name)
+        self.index.refresh(force=True)
+        self.metrics.count('fetches')
+        self.metrics.count('bytesFetched', info['size'])
+
     def _start(self):
         """
-        Used internally to start the XML-RPC server.
+        Used internally to start the XML-RPC server, and the server for
+        the binary data port (unless self.dataPort is None). If the data
+        port is 0, any free port is used. Also starts pinging the other
+        Nodes in the background, and dumping the statistics to
+        self.statsFile (if any).
         """
-        s = SimpleXMLRPCServer(("", getPort(self.url)), logRequests=False)
+        t = Thread(target=self._pinger)
+        t.setDaemon(1)
+        t.start()
+        if self.statsFile:
+            t = Thread(target=self._dumper)
+            t.setDaemon(1)
+            t.start()
+        if self.dataPort is not None:
+            d = DataServer(("", self.dataPort), self, self.workers)
+            self.dataPort = d.server_address[1]
+            t = Thread(target=d.serve_forever)
+            t.setDaemon(1)
+            t.start()
+        s = PooledXMLRPCServer(("", getPort(self.url)), self.workers,
+                               logRequests=False)
         s.register_instance(self)
+        self.server = s
         s.serve_forever()
 
-    def _handle(self, query):
+    def _ask(self, handle, method, query, args, qid, hops):
         """
-        Used internally to handle queries.
+        Used internally to answer a query, either locally (using the
+        given handle method) or by passing it on under the name of the
+        given remote method. Queries that have been seen before are
+        dropped, file contents that were recently passed on are served
+        from the relay cache (if any), queries that recently failed with
+        at least as many hops to go fail at once, and queries that were
+        recently answered by another Node are sent straight to that Node.
+        """
+        origin = not qid
+        qid = self._see(qid, hops)
+        span = {'qid': qid, 'node': self.url, 'method': method,
+                'query': query, 'hops': hops, 'start': time(),
+                'outcome': 'local', 'via': ''}
+        try:
+            try:
+                start = time()
+                try: return handle(query, *args)
+                finally: self.metrics.record('handle', time() - start)
+            except UnhandledQuery:
+                if hops <= 0: raise
+                key = self._cacheKey(method, query, args)
+                if key:
+                    data = self.cache.get(*key)
+                    if data is not None:
+                        span['outcome'] = 'cached'
+                        self._pace(data)
+                        if method == 'queryChunk': return Binary(data)
+                        return data
+                span['outcome'] = 'relayed'
+                span['via'], answer = self._relay(method, query, args,
+                                                  qid, hops)
+                if method in ('query', 'queryChunk'):
+                    data = getattr(answer, 'data', answer)
+                    if key: self.cache.put(key[0], data)
+                    self._pace(data)
+                return answer
+        except UnhandledQuery:
+            span['outcome'] = 'unhandled'
+            raise
+        finally:
+            self._finish(span, origin)
+
+    def _finish(self, span, origin):
+        """
+        Used internally to record the span of a query, once the Node is
+        done with it, for the statistics and for tracing.
+        """
+        span['time'] = time() - span['start']
+        self.metrics.count(span['outcome'])
+        self.metrics.record(span['method'], span['time'])
+        self.traces.put(span['qid'],
+                        self.traces.get(span['qid'], []) + [span])
+        if origin: self.recent.append(span)
+
+    def _relay(self, method, query, args, qid, hops):
+        """
+        Used internally to pass a query on to the other Nodes. Returns
+        the URL of the Node that answered, and the answer.
+        """
+        key = self._routeKey(method, query, args)
+        if self.misses.get(key, 0) >= hops: raise UnhandledQuery
+        other = self.routes.get(key)
+        if other:
+            try:
+                return other, self._call(other, method, query,
+                                         *(args + (qid, hops - 1)))
+            except:
+                self.routes.discard(key)
+        start = time()
+        try:
+            answer = self._broadcast(method, query, args, qid, hops)
+        finally:
+            self.metrics.record('broadcast', time() - start)
+        return self.routes.get(key, ''), answer
+
+    def _routeKey(self, method, query, args):
+        """
+        Used internally to find the key under which the Node remembers
+        which Node answered a query, or that it failed. A chunk query
+        may fail because of its hash while other queries for the same
+        file don't, so the method and hash are part of the key.
+        """
+        hash = ''
+        if method == 'queryChunk': hash = args[2]
+        return method, query, hash
+
+    def _cacheKey(self, method, query, args):
+        """
+        Used internally to find the key (and time to live) under which
+        the answer to a query passed on for another Node is cached, or
+        None if it isn't. Chunks are cached only when their hash is
+        given, so they can't go stale; whole files are cached for
+        CACHED_FILE_TTL seconds.
+        """
+        if self.cache is None or getattr(context, 'peer', None) is None:
+            return None
+        if method == 'query':
+            return 'query %s' % query, CACHED_FILE_TTL
+        if method == 'queryChunk' and args[2]:
+            return 'chunk %s %d %d' % (args[2], args[0], args[1]), None
+        return None
+
+    def _see(self, qid, hops):
+        """
+        Used internally to give a new query an ID, or to drop a query
+        that has been seen before with at least as many hops to go. One
+        that comes again by a shorter path can reach further, so it is
+        handled again.
+        """
+        if not qid: qid = uuid4().hex
+        if not self.seen.increase(qid, hops):
+            self.metrics.count('duplicate')
+            raise DuplicateQuery
+        return qid
+
+    def _local(self, query):
+        """
+        Used internally to find the local file answering a query.
         """
         dir = self.dirname
         name = join(dir, query)
-        if not isfile(name): raise UnhandledQuery
+        if query not in self.index: raise UnhandledQuery
         if not inside(dir, name): raise AccessDenied
+        return name
+
+    def _upload(self, read, *args):
+        """
+        Used internally to serve the contents of a local file (as
+        returned by calling read with the given arguments) to another
+        Node, within the limits set by self.uploads. Calls made by the
+        Node itself, rather than in answer to a request, are not limited.
+        The upload slot is held until the response has been sent, since
+        the data may be read from the file only as it is written out.
+        """
+        peer = getattr(context, 'peer', None)
+        if peer is None: return read(*args)
+        self.uploads.start(peer)
+        try:
+            data = read(*args)
+            self.uploads.send(len(data))
+        except:
+            self.uploads.finish(peer)
+            raise
+        context.sent.append(lambda: self.uploads.finish(peer))
+        self.metrics.count('bytesServed', len(data))
+        return data
+
+    def _pace(self, data):
+        """
+        Used internally to hold back file contents passed on to another
+        Node from elsewhere (the other Nodes or the relay cache) so as to
+        keep within the upload rate. These don't take up upload slots.
+        """
+        if getattr(context, 'peer', None) is None: return
+        self.uploads.send(len(data))
+        self.metrics.count('bytesRelayed', len(data))
+
+    def _handle(self, query):
+        """
+        Used internally to handle queries.
+        """
+        return self._upload(self._readAll, self._local(query))
+
+    def _handleInfo(self, query):
+        """
+        Used internally to handle info queries.
+        """
+        return self._info(self._local(query))
+
+    def _handleChunk(self, query, offset, length, hash):
+        """
+        Used internally to handle chunk queries.
+        """
+        self._local(query)
+        return Binary(self._upload(self._read, query, offset, length, hash))
+
+    def _readAll(self, name):
+        """
+        Used internally to read a whole local file.
+        """
         return open(name).read()
 
-    def _broadcast(self, query, history):
+    def _read(self, query, offset, length, hash):
+        """
+        Used internally to read a chunk of a local file.
+        """
+        return self._chunk(query, offset, length, hash).read()
+
+    def _chunk(self, query, offset, length, hash):
+        """
+        Used internally to find a chunk of a local file (of at most
+        MAX_CHUNK_SIZE bytes), checking the hash of its contents if one
+        is given.
+        """
+        name = self._local(query)
+        if hash and self._info(name)['hash'] != hash: raise UnhandledQuery
+        return Chunk(name, offset, min(length, MAX_CHUNK_SIZE))
+
+    def _compressible(self, chunk, codec):
+        """
+        Used internally to check whether it's worth compressing the file
+        a chunk comes from with a codec, by compressing a sample of the
+        chunk. The verdict is remembered until the file is changed.
+        """
+        version = getmtime(chunk.name), codec
+        cached = self.compressible.get(chunk.name)
+        if cached and cached[0] == version: return cached[1]
+        worth = worthCompressing(chunk.sample(SAMPLE_SIZE), CODECS[codec][0])
+        self.compressible[chunk.name] = version, worth
+        return worth
+
+    def _info(self, name):
+        """
+        Used internally to find the size and hashes of a local file. They
+        are remembered until the file is changed.
+        """
+        stat = os.stat(name)
+        version = stat.st_mtime, stat.st_size
+        cached = self.hashes.get(name)
+        if cached and cached[0] == version: return cached[1]
+        whole = sha1()
+        blocks = []
+        f = open(name, 'rb')
+        try:
+            while True:
+                block = f.read(BLOCK_SIZE)
+                if not block: break
+                whole.update(block)
+                blocks.append(sha1(block).hexdigest())
+        finally:
+            f.close()
+        info = {'size': stat.st_size, 'hash': whole.hexdigest(),
+                'blocks': blocks}
+        self.hashes[name] = version, info
+        return info
+
+    def _resume(self, f, info):
+        """
+        Used internally to check the blocks already in a partial file
+        against their hashes. Returns the numbers of the blocks that are
+        missing or bad.
+        """
+        f.seek(0)
+        return [i for i, block in enumerate(info['blocks'])
+                if sha1(f.read(BLOCK_SIZE)).hexdigest() != block]
+
+    def _swarm(self, f, query, info, blocks, holders):
         """
-        Used internally to broadcast a query to all known Nodes.
+        Used internally to download the given blocks of a file from
+        several Nodes at once. Each Node gets a thread that keeps taking
+        blocks from a shared queue, so the faster Nodes end up sending
+        more of them. The blocks are sent over the binary data port of
+        the Node if possible, or else over XML-RPC. A Node that fails or
+        sends a bad block is dropped (and the block put back), as is one
+        that is SLOW_FACTOR times slower than the fastest. Returns the
+        blocks that are left.
         """
-        for other in self.known.copy():
-            if other in history: continue
+        pending = Queue()
+        for i in blocks: pending.put(i)
+        rates = dict.fromkeys(holders, 0)
+        lock = Lock()
+
+        def download(holder):
+            try:
+                port = self._call(holder, 'getDataPort')
+                conn = port and DataConnection(holder, port, self.timeout)
+            except:
+                conn = None
+            try: work(holder, conn)
+            finally:
+                if conn: conn.close()
+
+        def work(holder, conn):
+            while True:
+                try: i = pending.get_nowait()
+                except Empty: return
+                start = time()
+                try:
+                    if conn:
+                        data = conn.chunk(query, i * BLOCK_SIZE, BLOCK_SIZE,
+                                          info['hash'])
+                    else:
+                        data = self._call(holder, 'queryChunk', query,
+                                          i * BLOCK_SIZE, BLOCK_SIZE,
+                                          info['hash'], '', 0).data
+                except:
+                    data = None
+                if data is None or \
+                       sha1(data).hexdigest() != info['blocks'][i]:
+                    pending.put(i)
+                    with lock: del rates[holder]
+                    return
+                rate = len(data) / max(time() - start, 1e-6)
+                with lock:
+                    f.seek(i * BLOCK_SIZE)
+                    f.write(data)
+                    self._received(query, len(data))
+                    if rates[holder]: rate = (rates[holder] + rate) / 2
+                    rates[holder] = rate
+                    # Leave the rest to the faster Nodes:
+                    if rate * SLOW_FACTOR < max(rates.values()):
+                        del rates[holder]
+                        return
+
+        threads = [Thread(target=download, args=(holder,))
+                   for holder in holders]
+        for t in threads:
+            t.setDaemon(1)
+            t.start()
+        for t in threads: t.join()
+        left = []
+        while not pending.empty(): left.append(pending.get())
+        return sorted(left)
+
+    def _received(self, query, bytes):
+        """
+        Used internally to record that part of a file being downloaded
+        has come in.
+        """
+        transfer = self.transfers.get(query)
+        if transfer: transfer.add(bytes)
+
+    def _fetchBlock(self, query, info, i):
+        """
+        Used internally to get a block of a file, checked against its
+        hash. A bad block is asked for again, from scratch.
+        """
+        for attempt in range(MAX_ATTEMPTS):
+            data = self.queryChunk(query, i * BLOCK_SIZE, BLOCK_SIZE,
+                                   info['hash']).data
+            if sha1(data).hexdigest() == info['blocks'][i]: return data
+            self.routes.discard(self._routeKey('queryChunk', query,
+                                               (0, 0, info['hash'])))
+        raise UnhandledQuery('Bad block %d of %s' % (i, query))
+
+    def _call(self, other, method, *args):
+        """
+        Used internally to call a method on another Node, recording
+        whether it answered. A Node that times out on a query it may have
+        passed on could just be waiting for others itself, so that isn't
+        counted against it; whether it's alive is left to the pings.
+        """
+        try:
+            result = self.pool.call(other, method, *args)
+        except Fault, f:
+            if f.faultCode in (UNHANDLED, DUPLICATE, BUSY):
+                self.known.success(other)
+            else:
+                self.known.failure(other)
+            raise
+        except socket.timeout:
+            if method not in self.relayed: self.known.failure(other)
+            raise
+        except:
+            self.known.failure(other)
+            raise
+        self.known.success(other)
+        return result
+
+    def _ping(self, other):
+        """
+        Used internally to ping another Node, to measure its round-trip
+        time or to find out if it has come back after a failure.
+        """
+        start = time()
+        try: self.pool.call(other, 'ping')
+        except: self.known.failure(other)
+        else: self.known.success(other, time() - start)
+
+    def _dumper(self):
+        """
+        Used internally to write the statistics to self.statsFile (as
+        JSON) every STATS_INTERVAL seconds. The file is replaced in one
+        go, so it can be read at any time.
+        """
+        while True:
+            sleep(STATS_INTERVAL)
+            temp = '%s.%s' % (self.statsFile, uuid4().hex)
+            f = open(temp, 'w')
+            try: json.dump(self.stats(), f, indent=1, sort_keys=True)
+            finally: f.close()
+            os.rename(temp, self.statsFile)
+
+    def _pinger(self):
+        """
+        Used internally to ping the other Nodes every PING_INTERVAL
+        seconds (except the ones that are being left alone).
+        """
+        while True:
+            sleep(PING_INTERVAL)
+            inParallel(self._ping, self.known.ordered(), self.fanout)
+
+    def _search(self, search, pattern, qid, hops):
+        """
+        Used internally to perform a search. The local matches come
+        first; then the known Nodes are asked (up to self.fanout at a
+        time), and their answers added as they arrive, until the limit
+        is reached.
+        """
+        qid = self._see(qid, hops)
+        search.add(self._matches(pattern, search.limit))
+        if hops <= 0 or search.full(): return
+
+        def ask(other):
+            if search.full(): return
             try:
-                s = ServerProxy(other)
-                return s.query(query, history)
+                answer = self._call(other, 'search', pattern, search.limit,
+                                    qid, hops - 1)
+            except:
+                return
+            search.add(answer)
 
-            except Fault, f:
-                if f.faultCode == UNHANDLED: pass
-                else: self.known.remove(other)
+        inParallel(ask, self.known.ordered(), self.fanout)
+
+    def _matches(self, pattern, limit):
+        """
+        Used internally to find (at most limit of) the local files whose
+        names match a pattern.
+        """
+        match = re.compile(fnmatch.translate(pattern)).match
+        version, names = self.index.snapshot()
+        found = []
+        for name in names:
+            if len(found) >= limit: break
+            if match(name): found.append(name)
+        return found
+
+    def _gather(self, method, query, args, qid, hops):
+        """
+        Used internally to pass a query on to all known Nodes (up to
+        self.fanout at a time), collecting their answers, which are
+        lists, into a single list.
+        """
+        answers = []
+        lock = Lock()
+
+        def ask(other):
+            try:
+                answer = self._call(other, method, query,
+                                    *(args + (qid, hops - 1)))
             except:
-                self.known.remove(other)
+                return
+            with lock: answers.extend(answer)
+
+        inParallel(ask, self.known.ordered(), self.fanout)
+        return answers
+
+    def _broadcast(self, method, query, args, qid, hops):
+        """
+        Used internally to broadcast a query to all known Nodes, the
+        fastest first. Up to self.fanout Nodes are asked at the same time,
+        and the first answer wins. Nodes that haven't been asked by then
+        are skipped, and the answers from those still working on it are
+        ignored. Unless some of the Nodes had seen the query already (in
+        which case they are probably still working on it) or were too
+        busy to answer, a failure is remembered. If a Node was busy, the
+        caller is told so (with Busy), and may try again later.
+        """
+        key = self._routeKey(method, query, args)
+        others = Queue()
+        for other in self.known.ordered():
+            others.put(other)
+        count = others.qsize()
+        answers = Queue()
+        done = Event()
+        duplicate = Event()
+        busy = Event()
+
+        def ask():
+            while not done.isSet():
+                try: other = others.get_nowait()
+                except Empty: return
+                try:
+                    answer = self._call(other, method, query,
+                                        *(args + (qid, hops - 1)))
+                except Fault, f:
+                    if f.faultCode == DUPLICATE: duplicate.set()
+                    if f.faultCode == BUSY: busy.set()
+                    answers.put(None)
+                except:
+                    answers.put(None)
+                else:
+                    done.set()
+                    answers.put((other, answer))
+
+        for i in range(min(self.fanout, count)):
+            t = Thread(target=ask)
+            t.setDaemon(1)
+            t.start()
+        for i in range(count):
+            answer = answers.get()
+            if answer is not None:
+                other, answer = answer
+                self.routes.put(key, other)
+                return answer
+        if busy.isSet(): raise Busy
+        if not duplicate.isSet():
+            self.misses.put(key, max(hops, self.misses.get(key, 0)))
         raise UnhandledQuery
 
+def parse(argv):
+    """
+    Parses a command line giving the URL, directory and secret of a
+    Node, and options for its relay cache, uploads and statistics.
+    Returns the three arguments, and the options as keyword arguments.
+    """
+    parser = OptionParser(usage='%prog [options] url directory secret')
+    add = parser.add_option
+    add('--cache-dir', dest='cacheDir',
+        help='directory (of its own) for a relay cache')
+    add('--cache-size', dest='cacheSize', type='int',
+        default=RELAY_CACHE_SIZE, help='bytes kept in the relay cache')
+    add('--upload-rate', dest='uploadRate', type='int',
+        default=UPLOAD_RATE, help='bytes per second uploaded (0: any)')
+    add('--stats-file', dest='statsFile',
+        help='file to write the statistics to now and then')
+    opts, args = parser.parse_args(argv)
+    if len(args) != 3: parser.error('a URL, directory and secret needed')
+    return args, vars(opts)
+
 def main():
-    url, directory, secret = sys.argv[1:]
-    n = Node(url, directory, secret)
+    args, kwds = parse(sys.argv[1:])
+    n = Node(*args, **kwds)
     n._start()
 
-if __name__ == '__main__': main()
\ No newline at end of file
+if __name__ == '__main__': main()
@@ -1,14 +1,18 @@
-from xmlrpclib import ServerProxy, Fault
+from xmlrpclib import Fault
 from cmd import Cmd
 from random import choice
 from string import lowercase
-from server import Node, UNHANDLED
-from threading import Thread
+from server import Node, PeerPool, UNHANDLED
+from threading import Thread, Lock
+from Queue import Queue
 from time import sleep
-import sys
+import sys, shlex
 
 HEAD_START = 0.1 # Seconds
 SECRET_LENGTH = 100
+MAX_DOWNLOADS = 4 # Files downloaded at the same time
+WILDCARDS = '*?[' # Characters that make a name a pattern
+SEARCH_POLL = 0.2 # Seconds between checks for more search results
 
 def randomString(length):
     """
@@ -21,6 +25,103 @@ def randomString(length):
         chars.append(choice(letters))
     return ''.join(chars)
 
+def splitNames(line):
+    """
+    Splits a line into names, which are quoted if they contain spaces.
+    If the quotes don't match up (as in it's.txt), the line is simply
+    split at the spaces.
+    """
+    try: return shlex.split(line)
+    except ValueError: return line.split()
+
+def expand(server, names):
+    """
+    Expands the names that are shell-style patterns (such as '*.txt')
+    into the names of the matching files the Node can find, and returns
+    them along with the other names.
+    """
+    result = []
+    for name in names:
+        if [c for c in name if c in WILDCARDS]:
+            result.extend(server.search(name))
+        else:
+            result.append(name)
+    return result
+
+def describe(status):
+    """
+    Describes the progress of a download (as reported by the progress
+    method of a Node) in a single line.
+    """
+    size = max(status['size'], 1)
+    line = '%-30s %6.1f%% %10.1f KB/s' % (status['name'],
+                                          100.0 * status['done'] / size,
+                                          status['rate'] / 1024)
+    if status['eta'] < 0: return line + '  ETA unknown'
+    minutes, seconds = divmod(int(status['eta']), 60)
+    return line + '  ETA %d:%02d' % (minutes, seconds)
+
+class Downloader:
+    """
+    Has a Node download files in the background. The names are put in
+    a queue, and a fixed number of threads take them out one by one, so
+    no more than that many files are downloaded at the same time. When
+    a download is over, the given callback is called with the name of
+    the file and an error message (or None if all went well).
+    """
+    def __init__(self, server, secret, callback, threads=MAX_DOWNLOADS):
+        self.server = server
+        self.secret = secret
+        self.callback = callback
+        self.queue = Queue()
+        self.waiting = []
+        self.active = []
+        self.lock = Lock()
+        for i in range(threads):
+            t = Thread(target=self._work)
+            t.setDaemon(1)
+            t.start()
+
+    def add(self, name):
+        'Puts a file in the download queue'
+        with self.lock: self.waiting.append(name)
+        self.queue.put(name)
+
+    def progress(self):
+        """
+        Returns the lines describing the downloads in progress, followed
+        by the names of the files that are being looked up and of those
+        still waiting in the queue.
+        """
+        statuses = self.server.progress()
+        lines = [describe(status) for status in statuses]
+        started = [status['name'] for status in statuses]
+        with self.lock:
+            lines.extend('%-30s starting' % name for name in self.active
+                         if name not in started)
+            lines.extend('%-30s queued' % name for name in self.waiting)
+        return lines
+
+    def _work(self):
+        """
+        Used internally to keep downloading the files in the queue.
+        """
+        while True:
+            name = self.queue.get()
+            with self.lock:
+                self.waiting.remove(name)
+                self.active.append(name)
+            error = None
+            try:
+                self.server.fetch(name, self.secret)
+            except Fault, f:
+                if f.faultCode != UNHANDLED: error = f.faultString
+                else: error = "Couldn't find the file"
+            except Exception, e:
+                error = str(e)
+            with self.lock: self.active.remove(name)
+            self.callback(name, error)
+
 class Client(Cmd):
     """
     A simple text-based interface to the Node class.
@@ -42,18 +143,53 @@ class Client(Cmd):
         t.start()
         # Give the server a head start:
         sleep(HEAD_START)
-        self.server = ServerProxy(url)
+        self.server = PeerPool(timeout=None).proxy(url)
         for line in open(urlfile):
             line = line.strip()
             self.server.hello(line)
+        self.downloader = Downloader(self.server, self.secret, self.done)
+
+    def done(self, name, error):
+        "Called by the Downloader when a download is over."
+        if error: print error + ':', name
+        else: print 'Fetched', name
 
     def do_fetch(self, arg):
-        "Call the fetch method of the Server."
-        try:
-            self.server.fetch(arg, self.secret)
-        except Fault, f:
-            if f.faultCode != UNHANDLED: raise
+        """
+        Download files in the background. Several names may be given
+        (quoted if they contain spaces), and names like '*.txt' stand
+        for all the files that match.
+        """
+        names = expand(self.server, splitNames(arg))
+        if not names:
             print "Couldn't find the file", arg
+        for name in names:
+            self.downloader.add(name)
+
+    def do_search(self, arg):
+        """
+        Search the network for files whose names match a pattern such
+        as '*.txt' (or contain the given text), showing them as they are
+        found.
+        """
+        pattern = arg.strip() or '*'
+        if not [c for c in pattern if c in WILDCARDS]:
+            pattern = '*%s*' % pattern
+        sid = self.server.startSearch(pattern)
+        count = 0
+        while True:
+            result = self.server.results(sid, count)
+            for name in result['names']:
+                print name
+            count += len(result['names'])
+            if result['done']: break
+            sleep(SEARCH_POLL)
+        print count, 'files found'
+
+    def do_progress(self, arg):
+        "Show the progress of the downloads."
+        for line in self.downloader.progress():
+            print line
 
     def do_exit(self, arg):
         "Exit the program."
@@ -0,0 +1,162 @@
+from server import Node, UnhandledQuery, DuplicateQuery, MAX_HOPS
+from threading import Lock, enumerate as threads, current_thread
+from random import Random
+import sys
+
+class Network:
+    """
+    A simulated network of Nodes living in a single process. The Nodes
+    call each other directly instead of over XML-RPC, and the network
+    counts the messages they send.
+    """
+    def __init__(self):
+        self.nodes = {}
+        self.messages = 0
+        self.duplicates = 0
+        self.lock = Lock()
+
+    def add(self, node):
+        self.nodes[node.url] = node
+
+    def connect(self, a, b):
+        'Introduces two Nodes to each other'
+        self.nodes[a].hello(b)
+        self.nodes[b].hello(a)
+
+    def call(self, other, method, *args):
+        'Calls a method on a Node, counting the message'
+        with self.lock: self.messages += 1
+        try:
+            return getattr(self.nodes[other], method)(*args)
+        except DuplicateQuery:
+            with self.lock: self.duplicates += 1
+            raise
+
+    def drain(self):
+        """
+        Waits for the calls still going on: a broadcast returns with the
+        first answer, leaving the Nodes it asked at the same time (in
+        threads of their own) to finish in the background.
+        """
+        while True:
+            others = [t for t in threads() if t is not current_thread()]
+            if not others: return
+            for t in others: t.join()
+
+class Simulated:
+    """
+    A mix-in for Nodes that live in a Network, and whose files exist
+    only as names in memory.
+    """
+    def simulate(self, network):
+        'Puts the Node in a Network'
+        self.network = network
+        self.files = set()
+
+    def _call(self, other, method, *args):
+        return self.network.call(other, method, *args)
+
+    def _handleInfo(self, query):
+        if query not in self.files: raise UnhandledQuery
+        return {}
+
+class SimNode(Simulated, Node):
+    'A flooding Node in a simulated Network'
+    def __init__(self, network, url, fanout=1):
+        Node.__init__(self, url, '.', 'secret', fanout=fanout)
+        self.simulate(network)
+
+def ring(urls, random):
+    'Each Node knows its two neighbours'
+    return [(urls[i-1], urls[i]) for i in range(len(urls))]
+
+def star(urls, random):
+    'All Nodes know the first one'
+    return [(urls[0], url) for url in urls[1:]]
+
+def grid(urls, random):
+    'The Nodes form a (roughly) square grid'
+    side = int(len(urls) ** 0.5)
+    edges = []
+    for i in range(len(urls)):
+        if i % side: edges.append((urls[i-1], urls[i]))
+        if i >= side: edges.append((urls[i-side], urls[i]))
+    return edges
+
+def sparse(urls, random, degree=4):
+    'A ring plus random extra links, to about the given degree'
+    edges = ring(urls, random)
+    for i in range(len(urls) * (degree - 2) / 2):
+        edges.append(tuple(random.sample(urls, 2)))
+    return edges
+
+def complete(urls, random):
+    'Every Node knows every other Node'
+    return [(a, b) for i, a in enumerate(urls) for b in urls[i+1:]]
+
+TOPOLOGIES = [ring, star, grid, sparse, complete]
+
+def within(edges, origin, hops):
+    """
+    Returns the Nodes that can be reached from origin in at most the
+    given number of hops, following the edges either way.
+    """
+    neighbours = {}
+    for a, b in edges:
+        neighbours.setdefault(a, set()).add(b)
+        neighbours.setdefault(b, set()).add(a)
+    reached = set([origin])
+    frontier = reached
+    for i in range(hops):
+        frontier = set(other for url in frontier
+                       for other in neighbours.get(url, ())) - reached
+        reached |= frontier
+    return reached
+
+def simulate(topology, size, queries, fanout=1, seed=0):
+    """
+    Builds a Network with the given topology and number of Nodes, and
+    runs a number of queries from random Nodes for files held by other
+    random Nodes. Returns the average number of messages and dropped
+    duplicates per query, the fraction of queries answered, and the
+    fraction that could have been (with the holder within MAX_HOPS).
+    """
+    random = Random(seed)
+    network = Network()
+    urls = ['http://node%d:4242' % i for i in range(size)]
+    for url in urls:
+        network.add(SimNode(network, url, fanout))
+    edges = topology(urls, random)
+    for a, b in edges:
+        if a != b: network.connect(a, b)
+    found = reachable = 0
+    for i in range(queries):
+        # Every query is for a new file, so no cached answers are used:
+        query = 'file%d' % i
+        origin, holder = random.sample(urls, 2)
+        network.nodes[holder].files.add(query)
+        if holder in within(edges, origin, MAX_HOPS): reachable += 1
+        try:
+            network.nodes[origin].queryInfo(query)
+            found += 1
+        except UnhandledQuery:
+            pass
+        # Count the messages of this query before the next one starts:
+        network.drain()
+    return (float(network.messages) / queries,
+            float(network.duplicates) / queries,
+            float(found) / queries, float(reachable) / queries)
+
+def main():
+    args = map(int, sys.argv[1:])
+    size, queries, fanout = args + [50, 100, 1][len(args):]
+    print '%-10s %10s %12s %8s %10s' % ('Topology', 'Messages',
+                                        'Duplicates', 'Found', 'Reachable')
+    for topology in TOPOLOGIES:
+        messages, duplicates, found, reachable = \
+                  simulate(topology, size, queries, fanout)
+        print '%-10s %10.1f %12.1f %7.0f%% %9.0f%%' % \
+              (topology.__name__, messages, duplicates, found * 100,
+               reachable * 100)
+
+if __name__ == '__main__': main()
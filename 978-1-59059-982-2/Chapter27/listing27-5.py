@@ -0,0 +1,56 @@
+from xmlrpclib import ServerProxy
+from server import Node, PeerPool
+from threading import Thread
+from time import sleep, time
+from tempfile import mkdtemp
+from shutil import rmtree
+import sys
+
+HEAD_START = 0.1 # Seconds
+URL = 'http://localhost:4241'
+
+def unpooled(url):
+    'Makes each call through a new ServerProxy, as the Nodes used to'
+    def call(method, *args):
+        return getattr(ServerProxy(url), method)(*args)
+    return call
+
+def pooled(url):
+    'Makes all calls through a shared PeerPool'
+    pool = PeerPool()
+    def call(method, *args):
+        return pool.call(url, method, *args)
+    return call
+
+def run(call, threads, calls):
+    """
+    Makes the given number of (cheap) load calls in each of the given
+    number of threads, and returns the number of calls per second.
+    """
+    def work():
+        for i in range(calls):
+            call('load')
+    workers = [Thread(target=work) for i in range(threads)]
+    start = time()
+    for t in workers: t.start()
+    for t in workers: t.join()
+    return threads * calls / (time() - start)
+
+def main():
+    args = map(int, sys.argv[1:])
+    threads, calls = args + [4, 500][len(args):]
+    dirname = mkdtemp()
+    try:
+        n = Node(URL, dirname, 'secret')
+        t = Thread(target=n._start)
+        t.setDaemon(1)
+        t.start()
+        # Give the server a head start:
+        sleep(HEAD_START)
+        for connect in unpooled, pooled:
+            rate = run(connect(URL), threads, calls)
+            print '%-10s %8.0f requests/sec' % (connect.__name__, rate)
+    finally:
+        rmtree(dirname)
+
+if __name__ == '__main__': main()
@@ -0,0 +1,91 @@
+from server import Node, PeerPool, DataConnection, DataRequestHandler
+from server import BLOCK_SIZE
+from threading import Thread
+from time import sleep, time
+from tempfile import mkdtemp
+from shutil import rmtree
+from os.path import join
+import sys, os
+
+HEAD_START = 0.1 # Seconds
+URL = 'http://localhost:4241'
+KB = 1024
+MB = 1024 * KB
+GB = 1024 * MB
+SIZES = [KB, 32 * KB, MB, 32 * MB, 1024 * MB]
+
+def makeFile(dirname, size):
+    """
+    Creates a file of the given size, filled with random bytes, and
+    returns its name.
+    """
+    name = 'file%d' % size
+    block = os.urandom(min(size, MB))
+    f = open(join(dirname, name), 'wb')
+    for i in range(size / len(block)):
+        f.write(block)
+    f.close()
+    return name
+
+def xmlrpc(node, name, size):
+    'Downloads a file using XML-RPC'
+    pool = PeerPool()
+    for offset in range(0, size, BLOCK_SIZE):
+        pool.call(node.url, 'queryChunk', name, offset, BLOCK_SIZE,
+                  '', '', 0).data
+
+def binary(node, name, size):
+    'Downloads a file over the binary data port'
+    conn = DataConnection(node.url, node.dataPort)
+    for offset in range(0, size, BLOCK_SIZE):
+        conn.chunk(name, offset, BLOCK_SIZE)
+    conn.close()
+
+def copying(node, name, size):
+    """
+    Downloads a file over the binary data port, with the server reading
+    each chunk into a string before sending it, instead of sending it
+    straight from the file.
+    """
+    DataRequestHandler.zeroCopy = False
+    try: binary(node, name, size)
+    finally: DataRequestHandler.zeroCopy = True
+
+def measure(download, node, name, size):
+    """
+    Downloads a file, and returns the transfer rate in MB per second
+    and the CPU time (in seconds, for both ends) per GB.
+    """
+    start = time()
+    cpu = sum(os.times()[:2])
+    download(node, name, size)
+    cpu = sum(os.times()[:2]) - cpu
+    elapsed = max(time() - start, 1e-6)
+    return float(size) / MB / elapsed, cpu / (float(size) / GB)
+
+def main():
+    # The largest file size (in MB) may be given on the command line:
+    largest = MB * int((sys.argv[1:] or [64])[0])
+    dirname = mkdtemp()
+    try:
+        n = Node(URL, dirname, 'secret')
+        t = Thread(target=n._start)
+        t.setDaemon(1)
+        t.start()
+        # Give the server a head start:
+        sleep(HEAD_START)
+        print '%10s %-8s %10s %12s' % ('Size', 'Path', 'MB/s', 'CPU s/GB')
+        for size in SIZES:
+            if size > largest: break
+            name = makeFile(dirname, size)
+            n.index.refresh(force=True)
+            for download in xmlrpc, copying, binary:
+                rate, cpu = measure(download, n, name, size)
+                print '%9dK %-8s %10.1f %12.1f' % (size / KB,
+                                                   download.__name__,
+                                                   rate, cpu)
+            os.remove(join(dirname, name))
+    finally:
+        rmtree(dirname)
+
+if __name__ == '__main__': main()
@@ -0,0 +1,290 @@
+from server import Node, UnhandledQuery, MAX_HOPS, parse
+from xmlrpclib import Fault
+from threading import Thread, Lock
+from hashlib import sha1
+from time import time, sleep
+import sys
+
+ID_BITS  = 160 # Bits in the IDs of Nodes and keys (those of SHA-1)
+RING     = 2 ** ID_BITS
+
+STABILIZE_INTERVAL = 5.0   # Seconds between checks of the ring pointers
+PUBLISH_INTERVAL   = 60.0  # Seconds between publications of our files
+POINTER_TTL        = 180.0 # Seconds a published pointer is kept
+LOOKUP_HOPS        = 32    # Nodes a lookup may be passed on to at most
+
+def ringId(name):
+    """
+    Returns the position of a Node URL or file name on the ring.
+    """
+    return long(sha1(name).hexdigest(), 16)
+
+def toKey(id):
+    'Turns a position on the ring into a key that XML-RPC can carry'
+    return '%040x' % id
+
+def between(x, a, b):
+    """
+    Checks whether x lies in the interval (a, b] on the ring. If a and
+    b are equal, that's the whole ring.
+    """
+    if a < b: return a < x <= b
+    return x > a or x <= b
+
+class DHTNode(Node):
+    """
+    A Node that finds files using a distributed hash table (after the
+    Chord protocol) instead of flooding. The Nodes form a ring, ordered
+    by the hashes of their URLs. Every file name is hashed onto the same
+    ring, and the first Node following it is responsible for knowing
+    which Nodes have the file. Each Node keeps pointers to the Nodes
+    halfway around the ring, a quarter of the way, and so on (its
+    fingers), so finding the responsible Node takes O(log N) hops.
+    """
+    relayed = Node.relayed + ('findSuccessor',)
+
+    def __init__(self, url, dirname, secret, **kwds):
+        Node.__init__(self, url, dirname, secret, **kwds)
+        self.id = ringId(url)
+        self.successor = url
+        self.predecessor = ''
+        self.fingers = []
+        self.pointers = {}
+        self.ringLock = Lock()
+
+    def hello(self, other):
+        """
+        Used to introduce the Node to other Nodes. The first Node it is
+        introduced to is used to join the ring.
+        """
+        Node.hello(self, other)
+        if self.successor == self.url:
+            try: self.join(other)
+            except: pass
+        return 0
+
+    def join(self, other):
+        """
+        Joins the ring that the given Node is part of.
+        """
+        self.successor = self._call(other, 'findSuccessor', toKey(self.id))
+        self.stabilize()
+        return 0
+
+    def findSuccessor(self, key, hops=LOOKUP_HOPS):
+        """
+        Returns the URL of the Node responsible for the given key: the
+        first Node following it on the ring. If this Node doesn't know,
+        it asks the Node among its fingers that comes closest to the key
+        without passing it (or its successor, if no finger does). Each
+        Node asked uses up a hop, so that a lookup on a ring that isn't
+        consistent yet fails rather than going round and round.
+        """
+        id = long(key, 16)
+        if between(id, self.id, ringId(self.successor)):
+            return self.successor
+        if hops <= 0: raise UnhandledQuery
+        other = self._closestPreceding(id)
+        if other == self.url: other = self.successor
+        try:
+            return self._call(other, 'findSuccessor', key, hops - 1)
+        except Fault:
+            raise
+        except:
+            if other == self.successor: raise
+            return self._call(self.successor, 'findSuccessor', key,
+                              hops - 1)
+
+    def getPredecessor(self):
+        """
+        Returns the URL of the Node's predecessor on the ring, or an
+        empty string if it doesn't know it.
+        """
+        return self.predecessor
+
+    def notify(self, other):
+        """
+        Used by another Node to tell this one that it might be its
+        predecessor.
+        """
+        if not self.predecessor or other == self.url or \
+               between(ringId(other), ringId(self.predecessor), self.id):
+            if other != self.url: self.predecessor = other
+        return 0
+
+    def publish(self, key, holder):
+        """
+        Used by other Nodes to tell this one (which is responsible for
+        the key) that they have a file with that key.
+        """
+        with self.ringLock:
+            self.pointers.setdefault(key, {})[holder] = time() + POINTER_TTL
+        return 0
+
+    def lookup(self, key):
+        """
+        Returns the URLs of the Nodes known to have a file with the given
+        key.
+        """
+        now = time()
+        with self.ringLock:
+            holders = self.pointers.get(key, {})
+            for holder, expires in holders.items():
+                if expires < now: del holders[holder]
+            return holders.keys()
+
+    def locate(self, query, hash='', qid='', hops=MAX_HOPS):
+        """
+        Finds the Nodes that have the given file by looking it up in the
+        hash table. The hash of the contents is checked only if this
+        Node has the file itself.
+        """
+        holders = self._holders(query)
+        try:
+            name = self._local(query)
+            if not hash or self._info(name)['hash'] == hash:
+                holders.append(self.url)
+        except UnhandledQuery:
+            pass
+        return list(set(holders))
+
+    def fetch(self, query, secret):
+        """
+        Downloads a file, and tells the hash table that this Node has it.
+        """
+        Node.fetch(self, query, secret)
+        self._publish(query)
+        return 0
+
+    def stabilize(self):
+        """
+        Checks whether a new Node has come in between this Node and its
+        successor, and tells the successor about this Node. If the
+        successor is gone, the next live finger takes its place.
+        """
+        try:
+            other = self._call(self.successor, 'getPredecessor')
+        except:
+            self.successor = self._nextLive()
+            return
+        if other and other != self.url and \
+               between(ringId(other), self.id, ringId(self.successor)):
+            self.successor = other
+        if self.successor != self.url:
+            try: self._call(self.successor, 'notify', self.url)
+            except: pass
+
+    def fixFingers(self):
+        """
+        Updates the fingers. The finger for distance 2**i is the Node
+        responsible for the position that far along the ring; as long as
+        that position falls before the previous finger, it's the same
+        Node, so only O(log N) of them need to be looked up.
+        """
+        fingers = []
+        other = self.successor
+        for i in range(ID_BITS):
+            start = (self.id + 2 ** i) % RING
+            if not between(start, self.id, ringId(other)):
+                try: other = self.findSuccessor(toKey(start))
+                except: break
+            if other == self.url: break
+            if not fingers or fingers[-1][1] != other:
+                fingers.append((ringId(other), other))
+        self.fingers = fingers
+
+    def _start(self):
+        """
+        Used internally to start the servers, and the maintenance of the
+        ring in the background.
+        """
+        t = Thread(target=self._maintain)
+        t.setDaemon(1)
+        t.start()
+        Node._start(self)
+
+    def _maintain(self):
+        """
+        Used internally to keep the ring pointers up to date, and to
+        publish the local files now and then.
+        """
+        published = 0
+        while True:
+            sleep(STABILIZE_INTERVAL)
+            self.stabilize()
+            self.fixFingers()
+            if time() - published > PUBLISH_INTERVAL:
+                self.index.refresh()
+                for name in self.index.names: self._publish(name)
+                published = time()
+
+    def _relay(self, method, query, args, qid, hops):
+        """
+        Used internally to pass a query on to the Nodes that the hash
+        table says have the file, rather than flooding. Spans, the relay
+        cache and pacing are left to Node._ask, as for any other query.
+        Returns the URL of the Node that answered, and the answer.
+        """
+        for holder in self._holders(query):
+            if holder == self.url: continue
+            try:
+                return holder, self._call(holder, method, query,
+                                          *(args + (qid, 0)))
+            except:
+                pass
+        raise UnhandledQuery
+
+    def _holders(self, query):
+        """
+        Used internally to find the Nodes that have a given file, by
+        asking the Node responsible for its key.
+        """
+        key = toKey(ringId(query))
+        try:
+            other = self.findSuccessor(key)
+            if other == self.url: return self.lookup(key)
+            return self._call(other, 'lookup', key)
+        except:
+            return []
+
+    def _publish(self, name):
+        """
+        Used internally to tell the Node responsible for a file name that
+        this Node has the file.
+        """
+        key = toKey(ringId(name))
+        try:
+            other = self.findSuccessor(key)
+            if other == self.url: self.publish(key, self.url)
+            else: self._call(other, 'publish', key, self.url)
+        except:
+            pass
+
+    def _closestPreceding(self, id):
+        """
+        Used internally to find the finger that comes closest to a
+        position on the ring without passing it.
+        """
+        for fid, url in reversed(self.fingers):
+            if fid != id and between(fid, self.id, id): return url
+        return self.url
+
+    def _nextLive(self):
+        """
+        Used internally to find the first finger that still answers.
+        """
+        for fid, url in self.fingers:
+            if url == self.successor: continue
+            try:
+                self._call(url, 'ping')
+                return url
+            except:
+                pass
+        return self.url
+
+def main():
+    args, kwds = parse(sys.argv[1:])
+    n = DHTNode(*args, **kwds)
+    n._start()
+
+if __name__ == '__main__': main()
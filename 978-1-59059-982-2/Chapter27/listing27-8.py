@@ -0,0 +1,93 @@
+from dht import DHTNode
+from simulate import Network, Simulated, SimNode, sparse, simulate
+from server import UnhandledQuery
+from random import Random
+import sys
+
+SIZES = [10, 100, 1000]
+ROUNDS = 10 # Rounds of stabilization to get the ring right, at most
+
+class DHTSimNode(Simulated, DHTNode):
+    'A DHT Node in a simulated Network'
+    def __init__(self, network, url):
+        DHTNode.__init__(self, url, '.', 'secret')
+        self.simulate(network)
+
+def covered(network, urls):
+    'Returns the number of Nodes on the ring of successor pointers'
+    seen = set()
+    url = urls[0]
+    while url not in seen:
+        seen.add(url)
+        url = network.nodes[url].successor
+    return len(seen)
+
+def build(size):
+    """
+    Builds a Network of DHT Nodes, joining them to the ring one at a
+    time. After each join, the new Node's predecessor is stabilized
+    and the new Node's fingers are set up. Then every Node stabilizes
+    until the successor pointers go round all the Nodes (checked, as
+    the lookups count on it), and finally every Node updates its
+    fingers once.
+    """
+    network = Network()
+    urls = ['http://node%d:4242' % i for i in range(size)]
+    for url in urls:
+        network.add(DHTSimNode(network, url))
+    for url in urls[1:]:
+        node = network.nodes[url]
+        node.successor = network.call(urls[0], 'findSuccessor',
+                                      '%040x' % node.id)
+        before = network.nodes[node.successor].predecessor or \
+                 node.successor
+        node.stabilize()
+        network.nodes[before].stabilize()
+        node.fixFingers()
+    for i in range(ROUNDS):
+        if covered(network, urls) == size: break
+        for url in urls: network.nodes[url].stabilize()
+    assert covered(network, urls) == size, 'The ring is broken'
+    for url in urls:
+        network.nodes[url].fixFingers()
+    return network, urls
+
+def lookups(size, queries, seed=0):
+    """
+    Runs a number of queries from random Nodes in a DHT for files held
+    by other random Nodes, and returns the average number of messages
+    per query and the fraction of queries answered. Building the ring
+    and publishing the files isn't counted.
+    """
+    random = Random(seed)
+    network, urls = build(size)
+    pairs = []
+    for i in range(queries):
+        query = 'file%d' % i
+        origin, holder = random.sample(urls, 2)
+        network.nodes[holder].files.add(query)
+        network.nodes[holder]._publish(query)
+        pairs.append((query, origin))
+    network.messages = 0
+    found = 0
+    for query, origin in pairs:
+        try:
+            network.nodes[origin].queryInfo(query)
+            found += 1
+        except UnhandledQuery:
+            pass
+    return float(network.messages) / queries, float(found) / queries
+
+def main():
+    queries = int((sys.argv[1:] or [100])[0])
+    print '%6s %-10s %10s %8s' % ('Nodes', 'Mode', 'Messages', 'Found')
+    for size in SIZES:
+        messages, duplicates, found, reachable = simulate(sparse, size,
+                                                          queries)
+        print '%6d %-10s %10.1f %7.0f%%' % (size, 'flooding', messages,
+                                            found * 100)
+        messages, found = lookups(size, queries)
+        print '%6d %-10s %10.1f %7.0f%%' % (size, 'dht', messages,
+                                            found * 100)
+
+if __name__ == '__main__': main()
@@ -0,0 +1,196 @@
+from server import Node, PeerPool, MAX_WORKERS
+from simulate import TOPOLOGIES
+from threading import Thread, Lock
+from optparse import OptionParser
+from random import Random
+from tempfile import mkdtemp
+from shutil import rmtree
+from string import lowercase
+from time import sleep, time
+from os.path import join
+
+BASE_PORT = 4400 # Port of the first Node; the others follow it
+HEAD_START = 0.1 # Seconds
+KB = 1024
+
+# File sizes, and the fraction of the files that have them:
+SIZE_MIX = [(KB, 0.7), (64 * KB, 0.25), (1024 * KB, 0.05)]
+
+def options():
+    'Parses the command line'
+    parser = OptionParser(usage='%prog [options]')
+    add = parser.add_option
+    add('-n', '--nodes', type='int', default=20, help='number of Nodes')
+    add('-t', '--topology', default='sparse',
+        help='one of: ' + ', '.join(t.__name__ for t in TOPOLOGIES))
+    add('-f', '--files', type='int', default=200,
+        help='number of files shared')
+    add('-q', '--queries', type='int', default=1000,
+        help='number of queries in all')
+    add('-c', '--clients', type='int', default=8,
+        help='number of queries made at the same time')
+    add('-s', '--skew', type='float', default=1.0,
+        help='exponent of the Zipf popularity of the files')
+    add('-m', '--misses', type='float', default=0.1,
+        help='fraction of queries for files that nobody has')
+    add('-w', '--workers', type='int', default=MAX_WORKERS,
+        help='worker threads for each Node')
+    add('--seed', type='int', default=0, help='seed for the randomness')
+    return parser.parse_args()[0]
+
+def chooseSize(random):
+    'Picks a file size according to SIZE_MIX'
+    x = random.random()
+    for size, fraction in SIZE_MIX:
+        x -= fraction
+        if x < 0: return size
+    return SIZE_MIX[-1][0]
+
+def makeFiles(dirnames, count, random):
+    """
+    Creates the given number of files (of text, so they can be sent as
+    XML-RPC strings), each in the directory of a random Node, and returns
+    their names.
+    """
+    names = []
+    for i in range(count):
+        name = 'file%d' % i
+        size = chooseSize(random)
+        data = ''.join(random.choice(lowercase[:26]) for j in range(KB))
+        f = open(join(random.choice(dirnames), name), 'w')
+        for j in range(size / KB):
+            f.write(data)
+        f.close()
+        names.append(name)
+    return names
+
+class Zipf:
+    """
+    Picks items at random, the one with rank r (counting from 1) with a
+    probability proportional to 1/r**skew.
+    """
+    def __init__(self, items, skew, random):
+        self.items = items
+        self.random = random
+        weights = [1.0 / (r + 1) ** skew for r in range(len(items))]
+        total = sum(weights)
+        self.cumulative = []
+        running = 0.0
+        for weight in weights:
+            running += weight / total
+            self.cumulative.append(running)
+
+    def pick(self):
+        x = self.random.random()
+        lo, hi = 0, len(self.cumulative) - 1
+        while lo < hi:
+            mid = (lo + hi) / 2
+            if self.cumulative[mid] < x: lo = mid + 1
+            else: hi = mid
+        return self.items[lo]
+
+def startNodes(count, workers):
+    """
+    Starts the given number of Nodes, each with its own directory and
+    port, and waits until they are all serving.
+    """
+    nodes = []
+    for i in range(count):
+        url = 'http://localhost:%d' % (BASE_PORT + i)
+        n = Node(url, mkdtemp(), 'secret', workers=workers, dataPort=None)
+        # All the Nodes share one address, so limiting the uploads to
+        # each peer would limit them in all:
+        n.uploads.slots = n.uploads.bulk
+        t = Thread(target=n._start)
+        t.setDaemon(1)
+        t.start()
+        nodes.append(n)
+    while [n for n in nodes if n.server is None]:
+        sleep(HEAD_START)
+    return nodes
+
+def percentile(values, p):
+    'Returns the value that p percent of the (sorted) values do not exceed'
+    if not values: return 0.0
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+def messages(nodes):
+    """
+    Returns the number of queries the Nodes have handled, including the
+    ones dropped as duplicates.
+    """
+    total = 0
+    for n in nodes:
+        counters = n.metrics.status()['counters']
+        for name in 'local', 'cached', 'relayed', 'unhandled', 'duplicate':
+            total += counters.get(name, 0)
+    return total
+
+def run(workload, clients):
+    """
+    Makes the queries in the workload (pairs of names and Node URLs)
+    from the given number of threads at once.
+    Returns the latencies of the queries (sorted), the number of them
+    answered, and the time it all took.
+    """
+    pool = PeerPool(timeout=None)
+    latencies = []
+    found = [0]
+    lock = Lock()
+
+    def client():
+        while True:
+            with lock:
+                if not workload: return
+                name, url = workload.pop()
+            start = time()
+            try:
+                pool.call(url, 'query', name)
+                answered = 1
+            except:
+                answered = 0
+            elapsed = time() - start
+            with lock:
+                latencies.append(elapsed)
+                found[0] += answered
+
+    threads = [Thread(target=client) for i in range(clients)]
+    start = time()
+    for t in threads: t.start()
+    for t in threads: t.join()
+    return sorted(latencies), found[0], time() - start
+
+def main():
+    opts = options()
+    random = Random(opts.seed)
+    topology = dict((t.__name__, t) for t in TOPOLOGIES)[opts.topology]
+    nodes = startNodes(opts.nodes, opts.workers)
+    try:
+        names = makeFiles([n.dirname for n in nodes], opts.files, random)
+        for n in nodes: n.index.refresh(force=True)
+        urls = [n.url for n in nodes]
+        for a, b in topology(urls, random):
+            if a == b: continue
+            nodes[urls.index(a)].hello(b)
+            nodes[urls.index(b)].hello(a)
+        zipf = Zipf(names, opts.skew, random)
+        workload = []
+        for i in range(opts.queries):
+            if random.random() < opts.misses: name = 'missing%d' % i
+            else: name = zipf.pick()
+            workload.append((name, random.choice(urls)))
+        before = messages(nodes)
+        latencies, found, elapsed = run(workload, opts.clients)
+        sent = messages(nodes) - before - opts.queries
+        print '%d Nodes (%s), %d files, %d queries from %d clients' % \
+              (opts.nodes, opts.topology, opts.files, opts.queries,
+               opts.clients)
+        print 'Throughput:  %8.1f queries/sec' % (opts.queries / elapsed)
+        print 'Latency p50: %8.1f ms' % (percentile(latencies, 50) * 1000)
+        print 'Latency p99: %8.1f ms' % (percentile(latencies, 99) * 1000)
+        print 'Messages:    %8.1f per query' % (float(sent) / opts.queries)
+        print 'Answered:    %8.1f%%' % (100.0 * found / opts.queries)
+    finally:
+        for n in nodes: rmtree(n.dirname)
+
+if __name__ == '__main__': main()
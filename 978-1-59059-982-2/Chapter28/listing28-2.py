@@ -1,23 +1,115 @@
-from xmlrpclib import ServerProxy, Fault
-from server import Node, UNHANDLED
-from client import randomString
+from server import Node, PeerPool
+from client import randomString, splitNames, expand, Downloader
 from threading import Thread
 from time import sleep
-from os import listdir
-import sys
+from uuid import uuid4
+import sys, fnmatch
 import wx
 
 HEAD_START = 0.1 # Seconds
 SECRET_LENGTH = 100
+PROGRESS_INTERVAL = 1000 # Milliseconds between progress updates
+PAGE_SIZE = 200 # Names fetched at a time by the GUI
+MAX_PAGE = 1000 # Most names a ListableNode returns at a time
 
 
 class ListableNode(Node):
     """
     An extended version of Node, which can list the files
-    in its file directory.
+    in its file directory. The list is given a page at a time, along
+    with a change token; passing the token to the changes method later
+    tells what has been added or removed in the meantime.
     """
-    def list(self):
-        return listdir(self.dirname)
+    def __init__(self, *args, **kwds):
+        Node.__init__(self, *args, **kwds)
+        # Tokens from before a restart are recognized as stale:
+        self.epoch = uuid4().hex[:8]
+        self.matches = (None, None, [])
+
+    def list(self, start=0, count=PAGE_SIZE, pattern='*'):
+        """
+        Returns (at most MAX_PAGE of) the names, in sorted order, of the
+        files that match a shell-style pattern, starting with number
+        start. The result is a dictionary with the names, the total
+        number of matches, and a change token.
+        """
+        version, names = self._match(pattern)
+        count = min(count, MAX_PAGE)
+        return {'names': names[start:start+count], 'total': len(names),
+                'token': '%s:%d' % (self.epoch, version)}
+
+    def changes(self, token, pattern='*'):
+        """
+        Returns the names of the files matching a pattern that have been
+        added and removed since the given token was handed out, along
+        with a new token and the new total number of matches. If the
+        token is too old, reset is true, and the list must be reloaded.
+        """
+        epoch, sep, version = token.partition(':')
+        if epoch != self.epoch: version = -1
+        version, added, removed = self.index.since(int(version))
+        reset = added is None
+        if reset: added = removed = []
+        return {'token': '%s:%d' % (self.epoch, version), 'reset': reset,
+                'added': sorted(fnmatch.filter(added, pattern)),
+                'removed': sorted(fnmatch.filter(removed, pattern)),
+                'total': len(self._match(pattern)[1])}
+
+    def _match(self, pattern):
+        """
+        Used internally to find the (sorted) names matching a pattern,
+        along with the version of the index. The last answer is kept,
+        so paging through the matches doesn't mean filtering every time.
+        """
+        version, names = self.index.snapshot()
+        matches = self.matches
+        if matches[:2] != (version, pattern):
+            if pattern != '*': names = fnmatch.filter(names, pattern)
+            matches = self.matches = (version, pattern, names)
+        return version, matches[2]
+
+class FileList(wx.ListCtrl):
+    """
+    A virtual list control showing the files of a ListableNode. Only
+    the rows that are shown are asked for, a page at a time, and the
+    pages are kept until the Node reports a change.
+    """
+    def __init__(self, parent, server):
+        style = wx.LC_REPORT | wx.LC_VIRTUAL | wx.LC_NO_HEADER
+        wx.ListCtrl.__init__(self, parent, style=style)
+        self.InsertColumn(0, 'Name', width=2000)
+        self.server = server
+        self.setPattern('*')
+
+    def setPattern(self, pattern):
+        'Shows only the files matching a shell-style pattern'
+        self.pattern = pattern
+        result = self.server.list(0, 0, pattern)
+        self.token = result['token']
+        self.reset(result['total'])
+
+    def update(self):
+        'Asks the Node for changes, and shows them if there are any'
+        result = self.server.changes(self.token, self.pattern)
+        self.token = result['token']
+        if result['reset'] or result['added'] or result['removed']:
+            self.reset(result['total'])
+
+    def reset(self, total):
+        'Forgets the pages, so that the rows are asked for again'
+        self.pages = {}
+        self.SetItemCount(total)
+        self.Refresh()
+
+    def OnGetItemText(self, item, column):
+        page, i = divmod(item, PAGE_SIZE)
+        if page not in self.pages:
+            result = self.server.list(page * PAGE_SIZE, PAGE_SIZE,
+                                      self.pattern)
+            self.pages[page] = result['names']
+        names = self.pages[page]
+        if i < len(names): return names[i]
+        return ''
 
 class Client(wx.App):
     """
@@ -39,26 +131,68 @@ class Client(wx.App):
         t.start()
         # Give the server a head start:
         sleep(HEAD_START)
-        self.server = ServerProxy(url)
+        self.server = PeerPool(timeout=None).proxy(url)
         for line in open(urlfile):
             line = line.strip()
             self.server.hello(line)
+        self.downloader = Downloader(self.server, self.secret, self.done)
         # Get the GUI going:
         super(Client, self).__init__()
 
     def updateList(self):
         """
-        Updates the list box with the names of the files available
-        from the server Node.
+        Updates the list with the names of the files available from the
+        server Node, if they have changed.
         """
-        self.files.Set(self.server.list())
+        self.files.update()
 
+    def filterHandler(self, event):
+        """
+        Called when the filter text changes. Plain text shows the files
+        whose names contain it; a pattern like '*.txt' those matching it.
+        """
+        pattern = self.filter.GetValue() or '*'
+        if not [c for c in pattern if c in '*?[']:
+            pattern = '*%s*' % pattern
+        self.files.setPattern(pattern)
+
+    def tick(self, event):
+        """
+        Called by a timer every PROGRESS_INTERVAL milliseconds to update
+        the progress of the downloads and the list of files.
+        """
+        self.updateProgress()
+        self.updateList()
+
+    def updateProgress(self):
+        """
+        Updates the list box showing the progress of the downloads.
+        """
+        self.transfers.Set(self.downloader.progress())
+
+    def done(self, name, error):
+        """
+        Called by the Downloader (in its own thread) when a download is
+        over. The GUI is updated in the main thread.
+        """
+        wx.CallAfter(self.fetched, name, error)
+
+    def fetched(self, name, error):
+        """
+        Updates the lists after a download is over. If it failed, an
+        error message is printed.
+        """
+        if error: print error + ':', name
+        self.updateList()
+        self.updateProgress()
 
     def OnInit(self):
         """
         Sets up the GUI. Creates a window, a text field, a button, and
-        a list box, and lays them out. Binds the submit button to
-        self.fetchHandler.
+        a list of files with a filter field above it, and a list box
+        for the downloads in progress, and lays them out. Binds the
+        submit button to self.fetchHandler and the filter field to
+        self.filterHandler, and starts a timer for updating the lists.
         """
 
         win = wx.Frame(None, title="File Sharing Client", size=(400, 300))
@@ -75,16 +209,32 @@ class Client(wx.App):
         hbox.Add(input, proportion=1, flag=wx.ALL | wx.EXPAND, border=10)
         hbox.Add(submit, flag=wx.TOP | wx.BOTTOM | wx.RIGHT, border=10)
 
-        self.files = files = wx.ListBox(bkg)
-        self.updateList()
+        self.filter = filter = wx.TextCtrl(bkg)
+        filter.Bind(wx.EVT_TEXT, self.filterHandler)
+
+        fbox = wx.BoxSizer()
+        fbox.Add(wx.StaticText(bkg, label="Filter:"),
+                 flag=wx.ALIGN_CENTER_VERTICAL | wx.LEFT, border=10)
+        fbox.Add(filter, proportion=1, flag=wx.LEFT | wx.RIGHT, border=10)
+
+        self.files = files = FileList(bkg, self.server)
+
+        self.transfers = transfers = wx.ListBox(bkg)
 
         vbox = wx.BoxSizer(wx.VERTICAL)
         vbox.Add(hbox, proportion=0, flag=wx.EXPAND)
+        vbox.Add(fbox, proportion=0, flag=wx.EXPAND | wx.BOTTOM, border=10)
         vbox.Add(files, proportion=1,
                  flag=wx.EXPAND | wx.LEFT | wx.RIGHT | wx.BOTTOM, border=10)
+        vbox.Add(transfers, proportion=1,
+                 flag=wx.EXPAND | wx.LEFT | wx.RIGHT | wx.BOTTOM, border=10)
 
         bkg.SetSizer(vbox)
 
+        self.timer = wx.Timer(self)
+        self.Bind(wx.EVT_TIMER, self.tick, self.timer)
+        self.timer.Start(PROGRESS_INTERVAL)
+
         win.Show()
 
         return True
@@ -92,18 +242,18 @@ class Client(wx.App):
     def fetchHandler(self, event):
         """
         Called when the user clicks the 'Fetch' button. Reads the
-        query from the text field, and calls the fetch method of the
-        server Node. After handling the query, updateList is called.
-        If the query is not handled, an error message is printed.
+        names from the text field (names like '*.txt' stand for all the
+        files that match), and puts them in the download queue, so the
+        GUI doesn't freeze while they are downloaded. If no file is
+        found, an error message is printed.
         """
         query = self.input.GetValue()
-        try:
-            self.server.fetch(query, self.secret)
-            self.updateList()
-
-        except Fault, f:
-            if f.faultCode != UNHANDLED: raise
+        names = expand(self.server, splitNames(query))
+        if not names:
             print "Couldn't find the file", query
+        for name in names:
+            self.downloader.add(name)
+        self.updateProgress()
 
 def main():
     urlfile, directory, url = sys.argv[1:]